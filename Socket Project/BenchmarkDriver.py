@@ -0,0 +1,470 @@
+'''
+Developer: Austin Spencer
+Class: CSE 434 Computer Networks
+Professor: Syrotiuk
+Due: 10/17/2021
+Group: 85
+Ports: 4300 - 43499
+
+About:  Purpose of this project is to implement your own application program in which processes
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
+    answer queries using it.
+
+BenchmarkDriver.py:
+    - This script runs the benchmarks for the DHT pieces that can be measured on their own
+
+Usage:
+    python BenchmarkDriver.py ⟨benchmark⟩ [options]
+
+    python BenchmarkDriver.py hash [synthetic keys]
+    python BenchmarkDriver.py server [clients] [requests per client]
+    python BenchmarkDriver.py wire [iterations]
+    python BenchmarkDriver.py state [users]
+    python BenchmarkDriver.py load [rows]
+    python BenchmarkDriver.py hot [requests]
+'''
+
+
+from collections import Counter
+from csv import DictReader, DictWriter
+from loader import RecordLoader
+from hashing import HASH_FUNCTIONS
+from hashring import HashRing
+from hotkeys import HotKeys
+from Server import UDPServer
+from state import StateInfo
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import wire
+
+
+HASH_SIZE = 353 # Bucket count of the original list based hash table, used to show bucket skew
+FILE_PATH = "StatsCountry.csv"
+SYNTHETIC_KEYS = 100000
+NODE_COUNTS = [2, 4, 8, 16, 32]
+VIRTUAL_NODES = 16
+NAME_PREFIXES = ['', 'Republic of ', 'Kingdom of ', 'Federal Republic of ', 'United ', 'Islamic Republic of ', 'State of ']
+SERVER_PORT = 43400
+SERVER_CLIENTS = 200
+SERVER_REQUESTS = 25 # Requests each simulated client sends per command
+SERVER_TIMEOUT = 2.0
+WIRE_ITERATIONS = 2000
+WIRE_BATCH = 32 # Records in the benchmarked records batch, same as the default BATCH_SIZE
+WIRE_NODES = 64 # Nodes in the benchmarked setup-dht response
+STATE_USERS = 20000
+STATE_DHT_SIZE = 64
+STATE_QUERIES = 100000
+LOAD_ROWS = 500000
+LOAD_COLUMNS = ['Region', 'Currency Unit'] # Projection benchmarked against reading every column
+HOT_REQUESTS = 500000
+HOT_KEYS = 20000
+HOT_SKEW = 1.1 # Zipf exponent of how popular the benchmarked keys are
+HOT_THRESHOLD = 2000
+HOT_NODES = 16
+HOT_REPLICAS = 2
+SYLLABLES = ['an', 'bar', 'co', 'da', 'el', 'fi', 'go', 'ha', 'is', 'ja', 'ka', 'la', 'ma', 'ni', 'or',
+             'pa', 'qu', 'ra', 'sa', 'ta', 'ur', 'va', 'wa', 'xe', 'ya', 'zi', 'land', 'stan', 'ia', 'ne']
+
+
+def load_keys(synthetic_keys):
+    '''Read the Long Names out of the csv and pad them out with made up country names'''
+    with open(os.path.join(sys.path[0], FILE_PATH), "r") as data_file:
+        keys = [record['Long Name'] for record in DictReader(data_file)]
+
+    csv_keys = len(keys)
+    seen = set(keys)
+    generator = random.Random(434)
+    while len(keys) < csv_keys + synthetic_keys:
+        words = [''.join(generator.choice(SYLLABLES) for _ in range(generator.randint(2, 4))).capitalize()
+                 for _ in range(generator.randint(1, 3))]
+        key = generator.choice(NAME_PREFIXES) + ' '.join(words)
+        if key not in seen:
+            seen.add(key)
+            keys.append(key)
+
+    return keys, csv_keys
+
+
+def load_ratio(counts):
+    '''Max load divided by the mean load'''
+    return max(counts) / (sum(counts) / len(counts))
+
+
+def bucket_counts(hashes):
+    '''Count how many keys land in each of the HASH_SIZE buckets'''
+    buckets = [0] * HASH_SIZE
+    for key_hash in hashes:
+        buckets[key_hash % HASH_SIZE] += 1
+
+    return buckets
+
+
+def hash_benchmark(args):
+    '''
+        Hash every key with each hash function and report throughput along with
+        how evenly the keys spread over the buckets and over the nodes
+    '''
+    synthetic_keys = int(args[0]) if args else SYNTHETIC_KEYS
+    keys, csv_keys = load_keys(synthetic_keys)
+    print(f"\nHashing {len(keys)} keys ({csv_keys} from {FILE_PATH}, {len(keys) - csv_keys} synthetic)\n")
+
+    for name, hash_function in HASH_FUNCTIONS.items():
+        start_time = time.perf_counter()
+        hashes = [hash_function(key) for key in keys]
+        elapsed = time.perf_counter() - start_time
+
+        buckets = bucket_counts(hashes)
+
+        print(f"{name}:")
+        print(f"\tThroughput: {len(keys) / elapsed:,.0f} hashes/sec")
+        print(f"\tBuckets: max/mean {load_ratio(buckets):.2f}, empty {buckets.count(0)} of {HASH_SIZE}")
+
+        print(f"\tPer node max/mean (all keys / {FILE_PATH} only):")
+        for n in NODE_COUNTS:
+            dht = [{'id': i, 'username': f'node{i}'} for i in range(n)]
+            ring = HashRing(dht, VIRTUAL_NODES, hash_function)
+            modulo = [0] * n
+            consistent = [0] * n
+            csv_modulo = [0] * n
+            csv_consistent = [0] * n
+            for index, key_hash in enumerate(hashes):
+                owner_id = ring.owner(key_hash)['id']
+                modulo[key_hash % n] += 1
+                consistent[owner_id] += 1
+                if index < csv_keys:
+                    csv_modulo[key_hash % n] += 1
+                    csv_consistent[owner_id] += 1
+
+            print(f"\t\tn={n:<3} key_hash % n {load_ratio(modulo):.2f} / {load_ratio(csv_modulo):.2f}, "
+                  f"ring with {VIRTUAL_NODES} vnodes {load_ratio(consistent):.2f} / {load_ratio(csv_consistent):.2f}")
+        print()
+
+
+def letters(number):
+    '''Turn a number into a lowercase string since usernames have to be alphabetic'''
+    name = ''
+    while True:
+        number, digit = divmod(number, 26)
+        name = chr(ord('a') + digit) + name
+        if not number:
+            return name
+
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+
+async def run_clients(clients, commands):
+    '''
+        Every client sends its commands one at a time, waiting on each response before the next
+        Returns the elapsed time, the latency of each request, the failures and the timeouts
+    '''
+    server_addr = ('127.0.0.1', SERVER_PORT)
+    latencies = []
+    results = {'failures': 0, 'timeouts': 0}
+
+    async def client_loop(client, client_commands):
+        for command in client_commands:
+            client.response = asyncio.get_running_loop().create_future()
+            sent = time.perf_counter()
+            client.sendto(bytes(command, 'utf-8'), server_addr)
+            try:
+                response = await asyncio.wait_for(client.response, SERVER_TIMEOUT)
+            except asyncio.TimeoutError:
+                results['timeouts'] += 1
+                continue
+            latencies.append(time.perf_counter() - sent)
+            if b'"SUCCESS"' not in response:
+                results['failures'] += 1
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*(client_loop(client, client_commands) for client, client_commands in zip(clients, commands)))
+    elapsed = time.perf_counter() - start_time
+
+    return elapsed, sorted(latencies), results
+
+
+async def server_load(client_count, requests):
+    '''Register client_count * requests users, build a DHT and then send query-dht from every client'''
+    clients = []
+    for _ in range(client_count):
+        client = UDPServer()
+        client.response = None
+        # Every response resolves whatever request the client is waiting on
+        await client.start(lambda data, addr, client=client: client.response and not client.response.done()
+                           and client.response.set_result(data), ('127.0.0.1', 0))
+        clients.append(client)
+
+    def report(command, count, elapsed, latencies, results):
+        print(f"{command}:")
+        print(f"\t{count} requests from {client_count} clients in {elapsed:.2f}s ({len(latencies) / elapsed:,.0f} req/s)")
+        if latencies:
+            print(f"\tLatency p50 {percentile(latencies, 0.5) * 1000:.2f} ms, p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+        print(f"\tFailures {results['failures']}, timeouts {results['timeouts']}\n")
+
+    # Ports are only reserved by the server, nothing listens on them
+    register_commands = []
+    for i in range(client_count):
+        register_commands.append([
+            f"register {letters(i * requests + j)} 127.0.0.1 {10000 + 2 * (i * requests + j)} {10001 + 2 * (i * requests + j)}"
+            for j in range(requests)
+        ])
+    elapsed, latencies, results = await run_clients(clients, register_commands)
+    report('register', client_count * requests, elapsed, latencies, results)
+
+    # The first few users maintain the DHT and every other one is free to query it
+    await run_clients(clients[:1], [[f"setup-dht 4 {letters(0)}", f"dht-complete {letters(0)}"]])
+    query_commands = [[f"query-dht {letters(i * requests + requests - 1)}"] * requests for i in range(client_count)]
+    elapsed, latencies, results = await run_clients(clients, query_commands)
+    report('query-dht', client_count * requests, elapsed, latencies, results)
+
+
+def server_benchmark(args):
+    '''
+        Start ServerDriver.py on its own and measure how many register and query-dht
+        requests per second it answers for many clients sending at once
+    '''
+    client_count = int(args[0]) if args else SERVER_CLIENTS
+    requests = int(args[1]) if len(args) > 1 else SERVER_REQUESTS
+
+    server = subprocess.Popen([sys.executable, os.path.join(sys.path[0], 'ServerDriver.py'), str(SERVER_PORT)],
+                              stdout=subprocess.DEVNULL)
+    try:
+        # Give the server a moment to bind before sending to it
+        time.sleep(0.5)
+        print(f"\nServer on port {SERVER_PORT}, {client_count} clients sending {requests} requests each\n")
+        asyncio.run(server_load(client_count, requests))
+    finally:
+        server.kill()
+
+
+def wire_messages():
+    '''One of each of the messages that make up most of the traffic'''
+    with open(os.path.join(sys.path[0], FILE_PATH), "r") as data_file:
+        records = list(DictReader(data_file))
+
+    dht = [{
+        'n': WIRE_NODES,
+        'id': i,
+        'username': letters(i),
+        'ip': '127.0.0.1',
+        'port': 43000 + 2 * i,
+        'query': 43001 + 2 * i,
+        'vnodes': 0
+    } for i in range(WIRE_NODES)]
+
+    return {
+        'query': {'data': 'query', 'key': records[0]['Long Name'], 'origin': ['127.0.0.1', 43011], 'rid': 42, 'hops': 3, 'ttl': 13},
+        'query-result': {'res': 'SUCCESS', 'type': 'query-result', 'data': {'record': records[0], 'hops': 3}, 'rid': 42},
+        f'records x{WIRE_BATCH}': {'res': 'SUCCESS', 'type': 'records', 'data': records[:WIRE_BATCH]},
+        f'DHT n={WIRE_NODES}': {'res': 'SUCCESS', 'type': 'DHT', 'data': dht},
+        'command': 'register austin 127.0.0.1 43010 43011'
+    }
+
+
+def wire_benchmark(args):
+    '''Encode and decode the common messages in both wire formats and compare the size and time'''
+    iterations = int(args[0]) if args else WIRE_ITERATIONS
+    print(f"\nEncoding and decoding every message {iterations} times\n")
+
+    for name, message in wire_messages().items():
+        print(f"{name}:")
+        for format in wire.FORMATS:
+            if isinstance(message, str):
+                encode = lambda: wire.encode_command(message, format)
+                decode = wire.decode_command
+            else:
+                encode = lambda: wire.encode(message, format)
+                decode = wire.decode
+
+            data = encode()
+            start_time = time.perf_counter()
+            for _ in range(iterations):
+                encode()
+            encode_time = (time.perf_counter() - start_time) / iterations
+
+            start_time = time.perf_counter()
+            for _ in range(iterations):
+                decode(data)
+            decode_time = (time.perf_counter() - start_time) / iterations
+
+            print(f"\t{format:<7} {len(data):>6} bytes, encode {encode_time * 1e6:8.1f} us, decode {decode_time * 1e6:8.1f} us")
+        print()
+
+
+def timed(name, count, function):
+    '''Call function count times and print the calls per second'''
+    start_time = time.perf_counter()
+    for i in range(count):
+        res, err = function(i)
+        if err:
+            sys.exit(f"{name} failed: {err}")
+    elapsed = time.perf_counter() - start_time
+    print(f"\t{name:<16} {count:>7} calls, {count / elapsed:12,.0f} calls/sec, {elapsed / count * 1e6:8.2f} us each")
+
+
+def state_benchmark(args):
+    '''
+        Run the commands straight against the server's StateInfo with a large state table
+        so the cost of the state lookups isn't hidden behind the sockets
+    '''
+    user_count = int(args[0]) if args else STATE_USERS
+    state = StateInfo(SERVER_PORT)
+    usernames = [letters(i) for i in range(user_count)]
+    # Queries come from the users registered last so they are never part of the DHT
+    free_users = usernames[STATE_DHT_SIZE:]
+    print(f"\nStateInfo with {user_count} registered users and a DHT of {STATE_DHT_SIZE}\n")
+
+    timed('register', user_count,
+          lambda i: state.register(['register', usernames[i], '127.0.0.1', str(SERVER_PORT + 1 + 2 * i), str(SERVER_PORT + 2 + 2 * i)]))
+    timed('setup-dht', 1, lambda i: state.setup_dht(['setup-dht', str(STATE_DHT_SIZE), usernames[0]]))
+    state.creating_dht = False
+    timed('query-dht', STATE_QUERIES, lambda i: state.valid_query(['query-dht', free_users[i % len(free_users)]]))
+
+    def leave(i):
+        state.leave_dht(['leave-dht', usernames[1]])
+        return state.dht_rebuilt(['dht-rebuilt', usernames[1], usernames[0]])
+
+    def join(i):
+        state.join_dht(['join-dht', usernames[1]])
+        return state.dht_rebuilt(['dht-rebuilt', usernames[1]])
+
+    timed('leave-dht', 1, leave)
+    timed('join-dht', 1, join)
+    state.tearing_down_dht = True
+    timed('teardown', 1, lambda i: state.teardown_complete(['teardown-complete', usernames[0]]))
+    timed('deregister', user_count, lambda i: state.deregister(['deregister', usernames[i]]))
+    print()
+
+
+def write_dataset(path, rows):
+    '''Write a csv of the given number of rows by repeating the country records under made up Long Names'''
+    with open(os.path.join(sys.path[0], FILE_PATH), "r") as data_file:
+        reader = DictReader(data_file)
+        records = list(reader)
+        columns = reader.fieldnames
+
+    with open(path, "w", newline='') as data_file:
+        writer = DictWriter(data_file, columns)
+        writer.writeheader()
+        for i in range(rows):
+            record = dict(records[i % len(records)])
+            record['Long Name'] = f"{record['Long Name']} {i}"
+            writer.writerow(record)
+
+
+def measure_load(read_rows):
+    '''Rows/sec of the reader along with the most memory it had allocated at once'''
+    start_time = time.perf_counter()
+    rows = read_rows()
+    elapsed = time.perf_counter() - start_time
+
+    tracemalloc.start()
+    read_rows()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return rows, rows / elapsed, peak
+
+
+def load_benchmark(args):
+    '''Stream a large csv through RecordLoader and compare it with reading it through DictReader'''
+    rows = int(args[0]) if args else LOAD_ROWS
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'dataset.csv')
+        write_dataset(path, rows)
+        print(f"\nLoading {rows} rows, {os.path.getsize(path) / 2**20:.1f} MB\n")
+
+        def dict_reader():
+            count = 0
+            with open(path, "r") as data_file:
+                for record in DictReader(data_file):
+                    count += 1
+            return count
+
+        def record_loader(columns=None):
+            count = 0
+            for chunk in RecordLoader(path, columns=columns).chunks():
+                count += len(chunk)
+            return count
+
+        readers = {
+            'DictReader': dict_reader,
+            'RecordLoader': record_loader,
+            f"RecordLoader {len(LOAD_COLUMNS) + 1} columns": lambda: record_loader(LOAD_COLUMNS)
+        }
+        for name, read_rows in readers.items():
+            count, rate, peak = measure_load(read_rows)
+            print(f"\t{name:<26} {count:>9} rows, {rate:12,.0f} rows/sec, peak {peak / 2**20:6.2f} MB allocated")
+        print()
+
+
+def hot_benchmark(args):
+    '''
+        Feed a Zipf skewed stream of requests through the HotKeys sketch, check the keys it reports hot
+        against exact counts and show how much spreading them out evens the load over the nodes
+    '''
+    requests = int(args[0]) if args else HOT_REQUESTS
+    keys, _ = load_keys(HOT_KEYS)
+    weights = [1 / (rank + 1) ** HOT_SKEW for rank in range(len(keys))]
+    stream = random.Random(434).choices(keys, weights, k=requests)
+    print(f"\n{requests} requests over {len(keys)} keys, Zipf exponent {HOT_SKEW}, threshold {HOT_THRESHOLD}\n")
+
+    sketch = HotKeys(HOT_THRESHOLD)
+    start_time = time.perf_counter()
+    for key in stream:
+        sketch.record(key)
+    elapsed = time.perf_counter() - start_time
+
+    exact = Counter(stream)
+    really_hot = set(key for key, count in exact.items() if count >= HOT_THRESHOLD)
+    print(f"\tHotKeys.record {requests / elapsed:12,.0f} requests/sec, "
+          f"{len(sketch.counters) * sketch.counters.itemsize / 1024:.0f} KB of counters")
+    print(f"\t{len(sketch.hot)} keys reported hot, {len(really_hot)} over the threshold, "
+          f"{len(sketch.hot - really_hot)} false positives, {len(really_hot - sketch.hot)} missed")
+    for key, count in sketch.hottest(3):
+        print(f"\t\t{key}: {count} counted, {exact[key]} requests")
+
+    hash_function = HASH_FUNCTIONS['blake2b']
+    for name, hot in [('every key on its owner', set()), (f"hot keys on {1 + HOT_REPLICAS} nodes", sketch.hot)]:
+        load = [0] * HOT_NODES
+        for key, count in exact.items():
+            owner = hash_function(key) % HOT_NODES
+            width = 1 + HOT_REPLICAS if key in hot else 1
+            for i in range(width):
+                load[(owner + i) % HOT_NODES] += count / width
+        print(f"\t{name:<24} max/mean load over {HOT_NODES} nodes {load_ratio(load):.2f}")
+    print()
+
+
+BENCHMARKS = {
+    'hash': hash_benchmark,
+    'server': server_benchmark,
+    'wire': wire_benchmark,
+    'state': state_benchmark,
+    'load': load_benchmark,
+    'hot': hot_benchmark
+}
+
+
+def main(args):
+    '''
+    Usage:
+        python BenchmarkDriver.py ⟨benchmark⟩ [options]
+
+        Benchmarks: hash, server, wire, state, load, hot
+    '''
+    if len(args) < 2 or args[1] not in BENCHMARKS:
+        sys.exit(main.__doc__)
+
+    BENCHMARKS[args[1]](args[2:])
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -12,53 +12,133 @@ About:  Purpose of this project is to implement your own application program in
 
 Client.py:
     - This file contains the Client class and some sub classes and facilitates the interaction 
-    between the client nodes.
+    between the client nodes. All four sockets of a client are owned by a single asyncio event loop
+    running on its own thread, the main thread only reads user input and hands commands to the loop.
 
 '''
 
 
 from Server import UDPServer
-from csv import DictReader
+from batcher import RecordBatcher
+from cache import QueryCache
+from hashring import HashRing
+from hashing import get_hash_function
+from hotkeys import HotKeys
+from loader import RecordLoader
+from metrics import HOP_BUCKETS, Metrics
+from store import LocalStore
+from membership import (build_finger_table, closest_finger, join_membership, leave_membership, replica_set,
+                        same_membership, successor_list)
+from snapshot import read_snapshot, snapshot_path, write_snapshot
+import wire
+from itertools import count
+import asyncio
+import csv
 import os
-from _thread import *
 import json
+import random
 import sys
+import threading
+import time
 
 
 class Client:
     '''The Client class that has a single instance for each client running'''
     def __init__(self, username, serv_ip, serv_port, client_ip, client_port, 
-                query_port, right_port, hash_size, buff_size, file_path):
+                query_port, right_port, buff_size, file_path, *, load_mode='ring',
+                batch_size=1, batch_bytes=None, hash_function='ascii', index_columns=(), query_ttl=16,
+                request_timeout=5.0, wire_format='json', reliable=False, query_cache=0,
+                routing_cache=False, view_check_interval=5.0, key_column='Long Name', load_columns=None,
+                snapshot_dir=None, snapshot_interval=30.0, replication=1, heartbeat_interval=0,
+                heartbeat_misses=3, successors=3, hot_key_threshold=0, hot_key_window=10.0, hot_replicas=2,
+                metrics_endpoint=None):
         # Constants
         self.BUFFER_SIZE = buff_size
-        self.HASH_SIZE = hash_size
         self.FILE_PATH = file_path
+        self.KEY_COLUMN = key_column
+        self.LOAD_COLUMNS = load_columns
+        self.SNAPSHOT_DIR = snapshot_dir
+        self.SNAPSHOT_INTERVAL = snapshot_interval
+        self.LOAD_MODE = load_mode
+        self.METRICS_ENDPOINT = metrics_endpoint
+        self.HEARTBEAT_INTERVAL = heartbeat_interval
+        self.HEARTBEAT_MISSES = heartbeat_misses
+        self.HOT_KEY_WINDOW = hot_key_window
+        self.HOT_REPLICAS = hot_replicas
+        self.SUCCESSORS = successors
+        self.QUERY_TTL = query_ttl
+        self.REPLICATION = replication
+        self.REQUEST_TIMEOUT = request_timeout
+        self.ROUTING_CACHE = routing_cache
+        self.VIEW_CHECK_INTERVAL = view_check_interval
+        self.WIRE_FORMAT = wire_format
+        self.hash_function = get_hash_function(hash_function)
 
         # Initialize the User subclass
         self.user = self.User(username, (serv_ip, serv_port), (client_ip, client_port), (client_ip, query_port), (client_ip, right_port))
 
+        # Counters and histograms of this node, every socket counts its own traffic into them
+        self.metrics = Metrics(node=username)
+        self.metrics.buckets['query_hops'] = HOP_BUCKETS
+
         # ClientServer subclass
-        self.sockets = self.ClientServer()
+        self.sockets = self.ClientServer(wire_format, reliable, self.metrics)
+
+        # Records sent between nodes are packed into batches no bigger than what the receiver can read
+        self.batcher = RecordBatcher(self.sockets.send_port, min(batch_bytes or buff_size, buff_size), batch_size)
+
+        # Consistent hash ring, only built when the DHT was set up with virtual nodes
+        self.ring = None
+
+        # Local store of the records this client is responsible for
+        self.local_store = LocalStore(key_column, index_columns)
+
+        # Results of queries that entered the DHT at this node, only kept when given a size
+        self.query_cache = QueryCache(query_cache) if query_cache else None
 
-        # Local hash table stored by the client
-        self.local_hash_table = [ [] for _ in range(hash_size) ]
+        # Sketch of how often the keys owned here are read, only kept when given a threshold
+        self.hot_keys = HotKeys(hot_key_threshold) if hot_key_threshold else None
+        # key hash -> nodes holding a hot key, set by whichever node owns it
+        self.hot_replicas = {}
+
+        # Store changes counter as of the last snapshot saved or restored
+        self.snapshot_changes = None
+
+        # Membership view fetched from the server so queries can go straight to the owner
+        # {'epoch', 'dht', 'ring'} along with when the server last confirmed the epoch
+        self.view = None
+        self.view_checked = 0
+
+        # Event loop that owns every socket, started by start()
+        self.loop = None
+        self.tasks = set()
 
         # Booleans and checks that are kept track of by the client
         self.record = None
-        self.query = None
-        self.began_query = False
-        self.new_leader = None
+        self.request_ids = count(1)
+        self.pending_queries = {}
+        self.pending_finds = {}
+        self.pending_batches = {}
+        self.terminated = False
         self.leaving_user = False
         self.joining_user = False
+        self.pending_pulls = set()
+        # Set from taking on the membership of a join until the joining node has pulled its records
+        # A key missed here in the meantime may not have moved yet so it is looked up on its previous holder
+        self.migrating = False
+        self.previous_ring = None
         self.started_check = False
 
+        self.register_gauges()
+
     class ClientServer:
         ''' UPDServer sockets'''
-        def __init__(self):
-            self.client_to_server = UDPServer()
-            self.accept_port = UDPServer()
-            self.query_port = UDPServer()
-            self.send_port = UDPServer()
+        def __init__(self, wire_format, reliable, metrics=None):
+            # Traffic between the nodes can go over the reliable channel, queries and the server stay plain UDP
+            self.client_to_server = UDPServer(wire_format, metrics=metrics, name='server')
+            self.accept_port = UDPServer(wire_format, reliable, metrics, 'accept')
+            self.query_port = UDPServer(wire_format, metrics=metrics, name='query')
+            self.send_port = UDPServer(wire_format, reliable, metrics, 'send')
 
     class User:
         '''Client user information'''
@@ -74,54 +154,196 @@ class Client:
             self.id = None
             self.n = None
             self.dht = None
+            self.finger_table = []
+            # Next few nodes around the DHT, a failed successor is routed around to the next one in the list
+            self.successors = []
+            # Membership before the last change, records are moved by comparing who held them then and now
+            self.previous_dht = None
 
-    def start_threads(self):
-        '''Begins the threads of the client servers to read in packages received'''
+    def start(self):
+        '''Begins the event loop thread and starts the client sockets on it'''
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.run(self.start_sockets())
+        if self.METRICS_ENDPOINT:
+            try:
+                self.run(self.metrics.serve(self.METRICS_ENDPOINT))
+                print(f"metrics: serving /metrics on {self.METRICS_ENDPOINT}\n")
+            except OSError as error:
+                print(f"metrics: could not serve on {self.METRICS_ENDPOINT}, {error}\n")
+        if self.SNAPSHOT_DIR:
+            self.run(self.restore_snapshot())
+            self.loop.call_soon_threadsafe(self.spawn, self.snapshot_loop())
+        if self.HEARTBEAT_INTERVAL:
+            self.loop.call_soon_threadsafe(self.spawn, self.heartbeat_loop())
+        if self.hot_keys is not None:
+            self.loop.call_soon_threadsafe(self.spawn, self.hot_key_loop())
+
+    def run(self, coroutine):
+        '''Run the coroutine on the client event loop from another thread and wait for its result'''
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def spawn(self, coroutine):
+        '''Schedule the coroutine on the event loop, holding on to the task until it is done'''
+        task = self.loop.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def start_sockets(self):
+        '''Bind the accept and query ports and start reading all four sockets on the event loop'''
         # Start the client server
         print('Starting client topology socket\n')
-        start_new_thread(self.initialize_acceptance_port, ())
+        try:
+            await self.sockets.accept_port.start(self.accept_datagram, self.user.accept_port_address)
+            print(f"client-server: Port server is listening to is: {self.user.accept_port_address[1]}\n")
+        except Exception as error:
+            print(error)
+            print(f"server: bind() failed for client: {self.user.accept_port_address}")
 
         # Start the client query server
         print("Starting client query socket\n")
-        start_new_thread(self.client_query_socket, ())
-            
+        try:
+            await self.sockets.query_port.start(self.client_query_conn, self.user.query_addr)
+            print(f"query-server: Port server is listening to is: {self.user.query_addr[1]}\n")
+        except Exception as error:
+            print(error)
+            print("query-server: bind() failed")
+
+        # The send port only ever receives responses to its own requests
+        await self.sockets.send_port.start(None)
+        await self.sockets.client_to_server.start(self.server_datagram)
 
-    def set_data(self, data, index=0):
+    def set_data(self, data, index=0, dht=None):
         '''This is a helper function to set the user data after receiving the information from the DHT leader'''
-        self.user.dht = data
+        self.user.dht = dht if dht else data
         self.user.prev_node_addr = (data[index]['ip'], int(data[index]['port']))
         self.user.id = data[index+1]['id']
         self.user.n = data[index+1]['n']
         self.user.next_node_addr = (data[index+2]['ip'], int(data[index+2]['port']))
         self.user.next_node_query_addr = (data[index+2]['ip'], int(data[index+2]['query']))
+        self.set_routing()
+
+    def adopt_membership(self, dht):
+        '''Take on the id and neighbors given to this user by a new membership list'''
+        self.user.previous_dht = self.user.dht
+        self.migrating = False
+        index = next(i for i, node in enumerate(dht) if node['username'] == self.user.username)
+        nodes = (dht[index-1], dht[index], dht[(index+1) % len(dht)])
+        self.set_data(nodes, dht=dht)
+
+    def set_routing(self):
+        '''Rebuild the finger table, the successor list and the hash ring from the current membership list'''
+        self.user.finger_table = build_finger_table(self.user.dht, self.user.id) if self.user.id is not None else []
+        self.user.successors = successor_list(self.user.dht, self.user.id, self.SUCCESSORS) if self.user.id is not None else []
+        # Hot keys are spread over the successors of their owner, which have just changed
+        hot_replicas = self.hot_replicas
+        self.hot_replicas = {}
+        if self.hot_keys is not None:
+            self.hot_keys.reset()
+        vnodes = self.user.dht[0].get('vnodes', 0)
+        self.ring = HashRing(self.user.dht, vnodes, self.hash_function) if vnodes else None
+        self.drop_hot_copies(hot_replicas)
+
+    def drop_hot_copies(self, hot_replicas):
+        '''
+            Drop the extra copies of hot keys held here that the new membership doesn't put here
+            Their owners forget the hot keys too so a demotion would never come, and with a hash ring only
+            some nodes are asked to rehome. Copies this node held before anyway are left for rehome_records
+        '''
+        if not hot_replicas:
+            return
+
+        old_dht = self.user.previous_dht
+        old_ring = HashRing(old_dht, self.ring.vnodes, self.hash_function) if self.ring and old_dht else None
+        for record in self.local_store.all_records():
+            key_hash = self.key_hash(record)
+            if key_hash not in hot_replicas or self.holds(key_hash):
+                continue
+            old_holders = replica_set(old_dht, old_ring, key_hash, self.REPLICATION) if old_dht else []
+            if all(node['username'] != self.user.username for node in old_holders):
+                self.local_store.remove(record[self.KEY_COLUMN])
 
     def num_of_records(self):
         '''Helper function that is only used for debugging purposes when ouputing the node info'''
-        count = 0
-        for list_of_records in self.local_hash_table:
-            for _ in list_of_records:
-                count += 1
-
-        return f"\tRecords held in hash: {count}"
+        info = f"\tRecords held in store: {len(self.local_store)}"
+        if self.REPLICATION > 1 and self.user.dht:
+            primary = sum(1 for record in self.local_store.all_records() if self.owner_id(self.key_hash(record)) == self.user.id)
+            info += f"\n\tPrimary copies: {primary}, replicas: {len(self.local_store) - primary}"
+        return info
 
     def output_node_info(self):
         '''Debugging function, prints the info held on the user instance'''
         print(json.dumps(vars(self.user), sort_keys=False, indent=4))
         print("\n", self.num_of_records())
+        if self.query_cache is not None:
+            print(f"\tQuery cache: {self.query_cache.stats()}")
+        if self.hot_keys is not None:
+            print(f"\tHot keys: {self.hot_keys.stats()}")
+            for key, count in self.hot_keys.hottest():
+                nodes = self.hot_replicas.get(self.hash_function(key))
+                print(f"\t\t{key}: {count}{f' (hot, on {nodes} nodes)' if nodes else ''}")
+
+    def register_gauges(self):
+        '''Queue depths and sizes read off the node whenever its metrics are asked for'''
+        gauge = self.metrics.gauge
+        for server in (self.sockets.accept_port, self.sockets.send_port):
+            channel = server.channel
+            gauge('reliable_in_flight', channel.in_flight, socket=server.name)
+            gauge('reliable_queued', channel.queued, socket=server.name)
+            gauge('reliable_retransmissions', lambda channel=channel: channel.retransmissions, socket=server.name)
+            gauge('reliable_give_ups', lambda channel=channel: channel.give_ups, socket=server.name)
+        gauge('batcher_pending_records', lambda: sum(len(records) for records, _ in self.batcher.pending.values()))
+        gauge('pending_queries', lambda: len(self.pending_queries))
+        gauge('pending_batch_keys', lambda: sum(len(batch['waiting']) for batch in self.pending_batches.values()))
+        gauge('pending_finds', lambda: len(self.pending_finds))
+        gauge('server_waiters', lambda: len(self.sockets.client_to_server.waiters))
+        gauge('event_loop_tasks', lambda: len(self.tasks))
+        gauge('store_records', lambda: len(self.local_store))
+        if self.query_cache is not None:
+            gauge('query_cache_entries', lambda: len(self.query_cache))
+        if self.hot_keys is not None:
+            gauge('hot_keys', lambda: len(self.hot_keys.hot))
+
+    def output_stats(self):
+        '''Prints the counters, queue depths and histograms of this node for the stats command'''
+        print(f"\n{self.user.username}: {self.metrics.report()}\n")
+
+    def key_hash(self, record):
+        '''Hash the key of the record with the configured hash function'''
+        return self.hash_function(record[self.KEY_COLUMN])
+
+    def owner_id(self, key_hash):
+        '''
+            Find the id of the node that owns the key with the given hash
+            With a hash ring the owner is the next point clockwise, otherwise it is key_hash % n
+        '''
+        if self.ring:
+            return self.ring.owner(key_hash)['id']
+
+        return key_hash % self.user.n
+
+    def replicas(self, key_hash):
+        '''
+            The nodes holding the key under the current membership, the owner first then its REPLICATION - 1 successors
+            Hot keys are held by more successors
+        '''
+        return replica_set(self.user.dht, self.ring, key_hash, self.hot_replicas.get(key_hash, self.REPLICATION))
+
+    def holds(self, key_hash):
+        '''Check if this node is one of the replicas of the key'''
+        return any(node['username'] == self.user.username for node in self.replicas(key_hash))
+
+    def store_primary(self, record):
+        '''Store a record this node owns and push a copy to each of its successors holding the replicas'''
+        self.local_store.put(record)
+        for node in self.replicas(self.key_hash(record))[1:]:
+            self.batcher.add((node['ip'], int(node['port'])), record, type='handoff')
 
-    def hash_pos(self, record):
-        '''Calculate the pos variable with this hash function'''
-        ascii_sum = 0
-        for letter in record['Long Name']:
-            ascii_sum += ord(letter)
-        
-        return ascii_sum % self.HASH_SIZE
-    
     def end_script(self, message):
-        '''Function that will terminate the script gracefully'''
+        '''Function that will terminate the script gracefully, the main thread exits once it sees terminated set'''
         if message:
             print(message)
-        sys.exit()
+        self.terminated = True
 
     def check_record(self, record):
         '''
@@ -129,178 +351,297 @@ class Client:
             If it is not set the self.record value to the record which will
             trigger the query socket and send the query command to next node
         '''
-        pos = self.hash_pos(record)
-        id = pos % self.user.n
+        id = self.owner_id(self.key_hash(record))
         if id == self.user.id:
             # This is the desired location for record!
-            self.local_hash_table[pos].append(record)
+            self.store_primary(record)
         else:
-            try:
-                # print(f"sending to next node addr {client.user.next_node_addr}")
-                self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='record', data=record)
-            except:
-                print("client-node: sendall() error within records connect nodes")
-
-    def setup_all_local_dht(self, print_input=True):
-        '''This function will read in the records one by one and call to check the record'''
-        with open(os.path.join(sys.path[0], self.FILE_PATH), "r") as data_file:
-            csv_reader = DictReader(data_file)
-            total_records = 0
-            # Iterate over each row in the csv using reader object
-            print("\nSending records through DHT to store.\n")
-            for record in csv_reader:
-                self.check_record(record)
-                total_records += 1
-                if total_records % 50 == 0:
-                    print(f"\t{total_records} records stored so far...")
-            print(f"\n\t{total_records} records stored in total")
-            if print_input:
-                print("\nEnter command for the server: ")
+            # print(f"sending to next node addr {client.user.next_node_addr}")
+            self.batcher.add(self.user.next_node_addr, record)
+
+    def place_record(self, record):
+        '''
+            Send the record straight to the accept port of the node that owns it
+            Used by the node loading the file since it already holds the full membership list
+        '''
+        id = self.owner_id(self.key_hash(record))
+        if id == self.user.id:
+            self.store_primary(record)
+        else:
+            owner = self.user.dht[id]
+            self.batcher.add((owner['ip'], int(owner['port'])), record)
+
+    async def rehome_records(self, lost=()):
+        '''
+            Once the membership changes hand every record held locally straight to the nodes that hold it now
+            and didn't before, then drop the ones this node no longer holds. Only the node that owned a record
+            under the old membership sends it so each new replica gets it once, or the first of its old replicas
+            still alive if the owner is one of the lost usernames
+            With a hash ring only the records on arcs that changed hands move, the rest stay put
+            A big store takes a while to go through so heartbeats and queries are answered along the way
+        '''
+        old_dht = self.user.previous_dht
+        old_ring = HashRing(old_dht, self.ring.vnodes, self.hash_function) if self.ring and old_dht else None
+        moved = 0
+        for i, record in enumerate(self.local_store.all_records(), 1):
+            if i % 50 == 0:
+                await asyncio.sleep(0)
+            key_hash = self.key_hash(record)
+            holders = self.replicas(key_hash)
+            old_holders = replica_set(old_dht, old_ring, key_hash, self.REPLICATION) if old_dht else []
+            old_usernames = set(node['username'] for node in old_holders)
+            senders = [node['username'] for node in old_holders if node['username'] not in lost]
+            if not old_holders or senders[:1] == [self.user.username]:
+                for node in holders:
+                    if node['username'] != self.user.username and node['username'] not in old_usernames:
+                        self.batcher.add((node['ip'], int(node['port'])), record, type='handoff')
+                        moved += 1
+            if all(node['username'] != self.user.username for node in holders):
+                self.local_store.remove(record[self.KEY_COLUMN])
+        self.batcher.flush_all()
+
+        return moved
+
+    async def setup_all_local_dht(self, print_input=True):
+        '''
+            Stream the records out of the file a chunk at a time and send each one towards its owner
+            Every chunk is acked before the next is read so a big file never piles up in the send queues
+        '''
+        path = os.path.join(sys.path[0], self.FILE_PATH)
+        loader = RecordLoader(path, self.KEY_COLUMN, self.LOAD_COLUMNS)
+        self.batcher.reset_counters()
+        lost = 0
+        start_time = progress_time = time.perf_counter()
+        print(f"\nSending records from {path} through DHT to store.\n")
+        try:
+            for chunk in loader.chunks():
+                for i, record in enumerate(chunk, 1):
+                    if self.LOAD_MODE == 'direct':
+                        self.place_record(record)
+                    else:
+                        self.check_record(record)
+                    if i % 50 == 0:
+                        # Give the event loop a chance to answer queries and acks during a long load
+                        await asyncio.sleep(0)
+                self.batcher.flush_all()
+                lost += await self.sockets.send_port.drain()
+                if time.perf_counter() - progress_time >= 1:
+                    print(f"\t{loader.rows} records stored so far ({loader.rate():.0f} rows/sec)...")
+                    progress_time = time.perf_counter()
+        except (OSError, ValueError, UnicodeDecodeError, csv.Error) as error:
+            print(f"client: can't load the records, {error}")
+        self.batcher.flush_all()
+        # Nothing is finished until every node has acked its records
+        lost += await self.sockets.send_port.drain()
+        elapsed = time.perf_counter() - start_time
+
+        print(f"\n\t{loader.rows} records stored in total")
+        print(f"\tRead {loader.bytes_read} bytes{' memory mapped' if loader.mapped else ''} at {loader.rate():.0f} rows/sec, "
+              f"{loader.skipped} short rows skipped")
+        print(f"\t{self.batcher.records_sent} records sent in {self.batcher.datagrams_sent} datagrams "
+              f"in {elapsed:.3f}s ({loader.rows / elapsed if elapsed else 0:.0f} records/sec)")
+        if self.sockets.send_port.reliable:
+            print(f"\t{self.sockets.send_port.channel.retransmissions} retransmissions, {lost} datagrams never acked")
+        if print_input:
+            print("\nEnter command for the server: ")
     
     def teardown_dht(self, leaving):
-        '''Teardown DHT by removing all info on the user instance and resetting the hash table to empty'''
+        '''Teardown DHT by removing all info on the user instance and emptying the local store'''
         # Only teardown the local DHT, don't remove ID's or neighbors
-        self.local_hash_table = [ [] for _ in range(self.HASH_SIZE) ]
+        self.local_store.clear()
+        self.remove_snapshot()
+        self.migrating = False
+        if self.query_cache is not None:
+            self.query_cache.invalidate()
         if not leaving:
             self.user.id = None
             self.user.n = None
             self.user.dht = None
+            self.user.finger_table = []
+            self.user.successors = []
+            self.ring = None
             self.user.next_node_addr = None
             self.user.next_node_query_addr = None
             self.user.prev_node_addr = None
 
-    def initialize_acceptance_port(self):
+    async def save_snapshot(self):
         '''
-            Connecting socket between current client and the neighboring client
-            Once connection is made a new thread will be created to listen to that connection
+            Write the local store to disk tagged with the epoch the server has for the current membership
+            Nothing is saved while the membership is changing since the epoch wouldn't match the records
         '''
+        if self.user.id is None:
+            print("snapshot: this node isn't maintaining the DHT")
+            return False
 
         try:
-            self.sockets.accept_port.socket.bind(self.user.accept_port_address)
-        except Exception as error:
-                print(error)
-                print(f"server: bind() failed for client: {self.user.accept_port_address}")
-                return
-            
-        print(f"client-server: Port server is listening to is: {self.user.accept_port_address[1]}\n")
-        
-        # Add loop here so that we can disconnect and reconnect to server
-        while True:
-            
-            message, addr = self.sockets.accept_port.socket.recvfrom(self.BUFFER_SIZE)
+            data_loaded = await self.request_server(f'restore-view {self.user.username}')
+        except asyncio.TimeoutError:
+            print(f"snapshot: no response from the server to restore-view after {self.REQUEST_TIMEOUT}s")
+            return False
+        if data_loaded['res'] != 'SUCCESS':
+            print(f"snapshot: not saved, {data_loaded['data']}")
+            return False
+        if not same_membership(data_loaded['data']['dht'], self.user.dht):
+            print("snapshot: not saved, the membership is still changing")
+            return False
+
+        path = snapshot_path(self.SNAPSHOT_DIR, self.user.username)
+        epoch = data_loaded['data']['epoch']
+        changes = self.local_store.changes
+        records = self.local_store.all_records()
+        try:
+            # Encoding and writing a big store would hold up the sockets so it happens off the event loop
+            size = await self.loop.run_in_executor(None, write_snapshot, path, epoch, self.user.id, self.user.n, self.user.dht, records)
+        except OSError as error:
+            print(f"snapshot: can't write {path}, {error}")
+            return False
+
+        self.snapshot_changes = changes
+        print(f"snapshot: saved {len(records)} records ({size} bytes) to {path} at epoch {epoch}")
+        return True
+
+    async def restore_snapshot(self):
+        '''
+            Load the snapshot saved before this node restarted if the DHT is still at the same epoch with the
+            same membership, the node then answers queries straight away without any records being sent to it
+        '''
+        path = snapshot_path(self.SNAPSHOT_DIR, self.user.username)
+        if not os.path.exists(path):
+            return False
+
+        start_time = time.perf_counter()
+        try:
+            header, dht, records = await self.loop.run_in_executor(None, read_snapshot, path)
+        except (OSError, ValueError) as error:
+            print(f"snapshot: can't read {path}, {error}")
+            return False
+
+        try:
+            data_loaded = await self.request_server(f'restore-view {self.user.username}')
+        except asyncio.TimeoutError:
+            print(f"snapshot: no response from the server to restore-view after {self.REQUEST_TIMEOUT}s, {path} wasn't loaded")
+            return False
+        if (data_loaded['res'] != 'SUCCESS' or data_loaded['data']['epoch'] != header['epoch']
+                or not same_membership(data_loaded['data']['dht'], dht)):
+            print(f"snapshot: {path} is from epoch {header['epoch']} and the DHT has changed since, it wasn't loaded\n")
+            return False
 
-            # print(f"Client-server received message from addr: {addr}")
+        self.adopt_membership(dht)
+        for record in records:
+            self.local_store.put(record)
+        self.snapshot_changes = self.local_store.changes
+        elapsed = (time.perf_counter() - start_time) * 1000
+        print(f"snapshot: restored {len(records)} records from {path} at epoch {header['epoch']} "
+              f"as id {self.user.id} of {self.user.n} in {elapsed:.1f} ms\n")
+        return True
 
-            self.client_acceptance(message, addr)
+    async def snapshot_loop(self):
+        '''Save a snapshot every SNAPSHOT_INTERVAL seconds if the store has changed since the last one'''
+        while not self.terminated:
+            await asyncio.sleep(self.SNAPSHOT_INTERVAL)
+            if self.user.id is not None and self.local_store.changes != self.snapshot_changes:
+                await self.save_snapshot()
 
-    def client_acceptance(self, data, addr):
+    def remove_snapshot(self):
+        '''The records are gone so a snapshot of them mustn't be restored'''
+        if self.SNAPSHOT_DIR:
+            try:
+                os.remove(snapshot_path(self.SNAPSHOT_DIR, self.user.username))
+            except FileNotFoundError:
+                pass
+        self.snapshot_changes = None
+
+    def accept_datagram(self, data, addr):
+        '''Every message on the accept port is handled in its own task so a slow one never holds up the socket'''
+        self.spawn(self.client_acceptance(data, addr))
+
+    async def client_acceptance(self, data, addr):
         '''
             Will keep the connection with neighboring client until there is a disconnect on their end
         '''
         if data:
-            data_loaded = data.decode('utf-8')
-            data_loaded = json.loads(data_loaded)
+            try:
+                data_loaded = wire.decode(data)
+            except (ValueError, UnicodeDecodeError) as error:
+                print(f"client-topology: unreadable message, {error}")
+                return
+            self.sockets.accept_port.count_message('received', wire.message_name(data_loaded))
             # print(f"client-topology: received message ``{data_loaded}''\n")
             if data_loaded['type'] == 'record':
                 self.check_record(record=data_loaded['data'])
+                self.batcher.flush_all()
+            elif data_loaded['type'] == 'records':
+                for record in data_loaded['data']:
+                    self.check_record(record=record)
+                self.batcher.flush_all()
             elif data_loaded['type'] == 'set-id':
-                self.set_data(data_loaded['data'])
+                self.set_data(data_loaded['data']['nodes'], dht=data_loaded['data']['dht'])
                 # print(vars(self.user))
-                self.sockets.accept_port.socket.sendto(b'SUCCESS', addr)
-            elif data_loaded['type'] == 'leaving-teardown':
-                # Call teardown but with the leaving var set to True
-                self.teardown_dht(True)
-                if self.leaving_user:
-                    # Now call to reset every node id
-                    print('Teardown complete now calling reset-id\n')
-                    self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='reset-id', data=0)
-                elif self.joining_user:
-                    print("Teardown complete now rebuilding the DHT\n")
-                    # We know that the next node is the leader so call for rebuild of DHT
-                    self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='rebuild-dht', data=self.user.accept_port_address)
-                else:
-                    # Continue with teardown
-                    self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='leaving-teardown')
+                self.sockets.accept_port.send_response(addr, res='SUCCESS', type='set-id', rid=data_loaded.get('rid'))
             elif data_loaded['type'] == 'teardown':
-                if self.user.id == 0:
-                    self.teardown_dht(False)
-                    # Send successful command to server
-                    self.sockets.client_to_server.socket.sendto(bytes(f'teardown-complete {self.user.username}', 'utf-8'), self.user.server_addr) 
-                    self.listen()
-                else:
-                    next_node_addr = self.user.next_node_addr
-                    self.teardown_dht(False)
-                    self.sockets.send_port.send_response(addr=next_node_addr, res='SUCCESS', type='teardown')
+                self.teardown_dht(False)
+                self.sockets.accept_port.send_response(addr, res='SUCCESS', type='teardown', rid=data_loaded.get('rid'))
+            elif data_loaded['type'] == 'repair':
+                await self.repair_membership(data_loaded['data']['dht'], data_loaded['data']['failed'])
+                self.sockets.accept_port.send_response(addr, res='SUCCESS', type='repair', rid=data_loaded.get('rid'))
+            elif data_loaded['type'] == 'hot-key':
+                self.set_hot_key(data_loaded['data']['key'], data_loaded['data']['replicas'])
+            elif data_loaded['type'] == 'handoff':
+                # The sender already worked out that this node holds these records under the current membership
+                for record in data_loaded['data']:
+                    self.local_store.put(record)
             elif data_loaded['type'] == 'reset-id':
-                new_id = int(data_loaded['data'])
                 if not self.leaving_user:
-                    self.user.id = new_id
-                    self.user.n = self.user.n - 1
-                    new_id += 1
-                    self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='reset-id', data=new_id)
+                    # Keep forwarding along the old ring so the pass makes it back to the leaving node
+                    next_node_addr = self.user.next_node_addr
+                    self.adopt_membership(data_loaded['data']['dht'])
+                    moved = await self.rehome_records()
+                    print(f"Node ID reset to {self.user.id}, handed off {moved} records\n")
+                    self.sockets.send_port.send_response(addr=next_node_addr, res='SUCCESS', type='reset-id', data=data_loaded['data'])
                 else:
                     # We know that the nodes have successfully been renumbered
-                    print("Node ID's successfully changed")
-                    # Call to convert neighbors or the nodes
-                    self.convert_neighbors()
+                    print("Node ID's successfully changed\nHanding off records to their new owners")
+                    await self.leave_dht(data_loaded['data']['dht'])
             elif data_loaded['type'] == 'reset-n':
-                if self.user.id == 0:
-                    # This is leader so set previous node and the new n
-                    self.user.n = self.user.n + 1
-                    data_loaded['data']['n'] = self.user.n
-                    self.user.prev_node_addr = data_loaded['data']['addr']
-                    self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='reset-n', data=data_loaded['data'])
-                elif self.user.username != data_loaded['data']['username']:
-                    self.user.n = self.user.n + 1
-                    if self.user.n - 2 == self.user.id:
-                        data_loaded['data']['prev'] = self.user.accept_port_address
-                        self.user.next_node_addr = tuple(data_loaded['data']['addr'])
-                        self.user.next_node_query_addr = tuple(data_loaded['data']['query'])
+                if 'dht' not in data_loaded['data']:
+                    # This is the leader so add the joining node to the membership list for everyone
+                    data_loaded['data']['dht'] = join_membership(self.user.dht, {
+                        'username': data_loaded['data']['username'],
+                        'ip': data_loaded['data']['addr'][0],
+                        'port': data_loaded['data']['addr'][1],
+                        'query': data_loaded['data']['query'][1],
+                        'vnodes': self.user.dht[0].get('vnodes', 0)
+                    })
+
+                if self.user.username != data_loaded['data']['username']:
+                    # The last node now points at the joining node so the pass ends there
+                    self.adopt_membership(data_loaded['data']['dht'])
+                    self.start_migration()
                     self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='reset-n', data=data_loaded['data'])
                 else:
                     # We know that the nodes have successfully been renumbered
                     print("Node size successfully changed\n")
-                    self.user.prev_node_addr = data_loaded['data']['prev']
-                    self.user.n = data_loaded['data']['n']
-                    self.user.id = self.user.n - 1
-
-                    print("Teardown the existing DHT\n")
-                    # Teardown the current DHT
-                    self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='leaving-teardown')
-            elif data_loaded['type'] == 'reset-left':
-                # print(data_loaded['data'])
-                if self.user.next_node_addr == tuple(data_loaded['data']['current']):
-                    # print("This is the prev node")
-                    self.user.next_node_addr = tuple(data_loaded['data']['new'])
-                    self.user.next_node_query_addr = tuple(data_loaded['data']['query'])
-                    self.sockets.send_port.send_response(addr=tuple(data_loaded['data']['current']), res='SUCCESS', type='reset-complete')
-                else:
-                    self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='reset-left', data=data_loaded['data'])
-            elif data_loaded['type'] == 'reset-right':
-                self.user.prev_node_addr = tuple(data_loaded['data'])
-                self.sockets.send_port.socket.sendto(bytes(self.user.username, 'utf-8'), addr)
-            elif data_loaded['type'] == 'reset-complete':
-                print('Received reset complete\nNow rebuilding DHT')
-                res_data = self.user.accept_port_address
-                self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='rebuild-dht', data=res_data)
-            elif data_loaded['type'] == 'rebuild-dht':
-                print("Received rebuild DHT command\nSetting up node ring")
-                # self.new_leader = self.username # Set new leader when we initialize the rebuild of DHT
-                self.setup_all_local_dht()
-                self.sockets.send_port.send_response(addr=tuple(data_loaded['data']), res='SUCCESS', type='dht-rebuilt')
-            elif data_loaded['type'] == 'dht-rebuilt':
-                success_string = bytes(f'dht-rebuilt {self.user.username} {self.new_leader}', 'utf-8')
-                if self.joining_user:
+                    self.adopt_membership(data_loaded['data']['dht'])
+                    # The joining node is always given the last id so the rest of the list is the old membership
+                    self.user.previous_dht = [node for node in self.user.dht if node['username'] != self.user.username]
+                    self.start_migration()
+                    self.pull_records()
+            elif data_loaded['type'] == 'pull-records':
+                moved = await self.rehome_records()
+                print(f"Handed off {moved} records to their new owners\n")
+                self.sockets.send_port.send_response(addr=tuple(data_loaded['data']), res='SUCCESS', type='pull-complete', data=self.user.username)
+            elif data_loaded['type'] == 'pull-complete':
+                self.pending_pulls.discard(data_loaded['data'])
+                if not self.pending_pulls:
                     self.joining_user = False
-                    success_string = bytes(f'dht-rebuilt {self.user.username}', 'utf-8')
-                self.leaving_user = False
-                
-                try:
-                    self.sockets.client_to_server.socket.sendto(success_string, self.user.server_addr)
-                    self.listen()
-                except:
-                    print("client: sendall() error sending success string")
-                    return
+                    self.migrating = False
+                    # Every record is where the new membership puts it so the nodes can stop asking the old holders
+                    for node in self.user.dht:
+                        if node['username'] != self.user.username:
+                            self.sockets.send_port.send_response(addr=(node['ip'], int(node['port'])), res='SUCCESS', type='join-complete')
+                    await self.send_command(f'dht-rebuilt {self.user.username}')
+            elif data_loaded['type'] == 'join-complete':
+                self.migrating = False
             elif data_loaded['type'] == 'check-nodes':
                 self.output_node_info()
                 if not self.started_check:
@@ -309,205 +650,971 @@ class Client:
                     self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='check-nodes')
 
 
-    def client_query_socket(self):
+    def client_query_conn(self, data, addr):
         '''
-            Set up the socket for query port which will accept all connections and then start
-            a new listening thread
+            Socket connection listener that will listen for query commands
         '''
+        if data:
+            try:
+                data_loaded = wire.decode(data)
+            except (ValueError, UnicodeDecodeError) as error:
+                print(f"query-server: unreadable message, {error}")
+                return
+            self.sockets.query_port.count_message('received', wire.message_name(data_loaded))
 
-        try:
-            self.sockets.query_port.socket.bind(self.user.query_addr)
-        except Exception as error:
-                print(error)
-                print("query-server: bind() failed")
+            if data_loaded.get('type') == 'query-result':
+                self.complete_query(data_loaded)
+                return
+            elif data_loaded.get('type') == 'find-result':
+                self.gather_find_result(data_loaded)
+                return
+            elif data_loaded.get('type') == 'batch-result':
+                for result in data_loaded['data']['results']:
+                    self.note_replicas(result['key'], result.get('replicas'))
+                    self.batch_result(data_loaded['rid'], result['key'], result['record'])
+                return
+            elif data_loaded.get('type') == 'heartbeat':
+                self.answer_heartbeat(data_loaded, addr)
+                return
+            elif data_loaded.get('type') == 'heartbeat-ack':
+                # Came back after the heartbeat had already been counted as missed
+                return
+            elif data_loaded.get('type') == 'query-cache':
+                if self.query_cache is not None:
+                    result = data_loaded['data']
+                    self.query_cache.put(result['key'], result['record'], result['epoch'])
                 return
             
-        # Add loop here so that we can disconnect and reconnect to server
-        print(f"query-server: Port server is listening to is: {self.user.query_addr[1]}\n")
-        
-        while True:
-            message = self.sockets.query_port.socket.recv(self.BUFFER_SIZE)
-            self.client_query_conn(message)
+            if data_loaded['data'] == 'query':
+                self.run_query(data_loaded)
+            elif data_loaded['data'] == 'query-batch':
+                self.run_batch(data_loaded)
+            elif data_loaded['data'] == 'find':
+                self.scatter_find(data_loaded)
+            elif data_loaded['data'] == 'find-local':
+                records = self.local_store.find(data_loaded['column'], data_loaded['value'])
+                if self.REPLICATION > 1 or self.hot_replicas:
+                    # Every node is asked so only answer with the records owned here, not the replicas
+                    records = [record for record in records if self.owner_id(self.key_hash(record)) == self.user.id]
+                self.send_find_results(tuple(data_loaded['origin']), data_loaded['rid'], records)
+            else:
+                print(json.dumps(data_loaded, sort_keys=False, indent=4))
 
-    def client_query_conn(self, data):
+    def send_query(self, key, addr, epoch=None, fallbacks=(), retried=False):
         '''
-            Socket connection listener that will listen for query commands
+            Send a query for the key to the given node query address without waiting on the result
+            epoch is the DHT epoch the server gave out with the address, nodes only cache results when it is given
+            fallbacks are the addresses of other replicas to try in turn if nothing comes back
+            retried is set on the one resend of a query that failed off a stale view
+            Returns the request id that the result will come back with
         '''
-        if data:
-            data_loaded = data.decode('utf-8')
+        rid = next(self.request_ids)
+        self.pending_queries[rid] = {'key': key, 'sent': time.perf_counter(), 'epoch': epoch, 'fallbacks': fallbacks, 'retried': retried}
+        # The node may have left or the datagram been lost, don't leave the query hanging forever
+        self.loop.call_later(self.REQUEST_TIMEOUT, self.expire_query, rid)
 
-            if data_loaded:
-                try:
-                    data_loaded = json.loads(data_loaded)
-                except:
-                    self.end_script("error with json.load")
+        query = {
+            'data': 'query',
+            'key': key,
+            'origin': self.user.query_addr,
+            'rid': rid,
+            'hops': 0,
+            'ttl': self.QUERY_TTL,
+            'epoch': epoch
+        }
+        try:
+            self.sockets.query_port.send_message(query, addr)
+        except:
+            print("client-node: sendall() error within query connection")
 
-            if type(data_loaded['data']) != str:
-                record = data_loaded['data']
-                if record == None:
-                    print(f"\n\nQuery for Long Name of {self.query}: 404 record not found\n")
-                else:
-                    print(f"\n\nQuery for Long Name of {self.query}:\n")
-                    print(json.dumps(data_loaded['data'], sort_keys=False, indent=4))
-                self.query = None
+        return rid
+
+    def complete_query(self, data_loaded):
+        '''Match the result to the pending query with the same request id and print it'''
+        if data_loaded.get('rid') in self.pending_batches:
+            # A key of a batch that had to be forwarded, the owner in the view was out of date
+            result = data_loaded['data']
+            self.view_checked = 0
+            if result.get('error') and self.retry_batch_key(data_loaded['rid'], result['key'], result['error']):
                 return
-            
-            # The data is a string so we can use the split method to create a list
-            data_list = data_loaded['data'].split()
+            self.note_replicas(result['key'], result.get('replicas'))
+            self.batch_result(data_loaded['rid'], result['key'], result['record'], result.get('error'), result.get('hops'))
+            return
 
-            if data_list[0] == 'query':
-                addr = tuple(data_loaded['origin'])
-                self.run_query(addr, data_list[1:])
-            else:
-                print(json.dumps(data_loaded, sort_keys=False, indent=4))
+        pending = self.pending_queries.pop(data_loaded.get('rid'), None)
+        if not pending:
+            # The query already got a result or was never sent from here
+            return
+
+        elapsed = (time.perf_counter() - pending['sent']) * 1000
+        result = data_loaded['data']
+        if result.get('error') and self.ROUTING_CACHE and not pending['retried']:
+            # The view sent the query to a node that has left or the membership moved under it, check the view and go again
+            print(f"\n\nQuery for {self.KEY_COLUMN} of {pending['key']}: {result['error']}, checking the view and trying again\n")
+            self.spawn(self.retry_query(pending))
+            return
+        self.observe_query(elapsed, result['hops'], data_loaded['res'], result.get('error'))
+        if not result.get('cached'):
+            self.note_replicas(pending['key'], result.get('replicas'))
+        if self.ROUTING_CACHE and self.query_cache is not None and not result.get('error'):
+            self.query_cache.put(pending['key'], result['record'], pending['epoch'])
+        if result['hops'] or result.get('error'):
+            # The view sent the query to a node that doesn't own the key, check for a new one next time
+            self.view_checked = 0
+        summary = f"(request {data_loaded['rid']}, {result['hops']} hops, {elapsed:.1f} ms{', cached' if result.get('cached') else ''})"
+        if data_loaded['res'] == 'SUCCESS':
+            print(f"\n\nQuery for {self.KEY_COLUMN} of {pending['key']}: {summary}\n")
+            print(json.dumps(result['record'], sort_keys=False, indent=4))
+        elif result.get('error'):
+            print(f"\n\nQuery for {self.KEY_COLUMN} of {pending['key']}: {result['error']} {summary}\n")
+        else:
+            print(f"\n\nQuery for {self.KEY_COLUMN} of {pending['key']}: 404 record not found {summary}\n")
+
+    async def retry_query(self, pending):
+        '''Send a query that failed off the view once more, to a replica in the new view or else the next one in the old'''
+        epoch = self.view['epoch'] if self.view else None
+        self.view_checked = 0
+        if not await self.refresh_view():
+            return
 
+        if self.view['epoch'] != epoch:
+            replicas = self.view_replicas(pending['key'])
+            random.shuffle(replicas)
+            addrs = [(node['ip'], int(node['query'])) for node in replicas]
+        else:
+            addrs = list(pending['fallbacks'])
+        if not addrs:
+            print(f"\n\nQuery for {self.KEY_COLUMN} of {pending['key']}: no other replica to try\n")
+            self.metrics.inc('queries_completed_total', kind='query', result='error')
+            return
+        self.send_query(pending['key'], addrs[0], self.view['epoch'], addrs[1:], retried=True)
 
-    def run_query(self, addr, long_name):
+    def retry_batch_key(self, rid, key, error):
         '''
-            Take in the query command and either return response with record found
-            or call the next node with the same query command
+            Queue a batch key that failed off a stale view to be sent again once the view has been checked
+            Returns False if the key was already tried again, its error is then its result
         '''
-        pos = self.hash_pos({'Long Name': ' '.join(long_name)})
-    
-        id = pos % self.user.n
-        if id == self.user.id:
-            # This is the correct node for query
-            records = self.local_hash_table[pos]
-            for record in records:
-                if record['Long Name'] == ' '.join(long_name):
-                    self.began_query = False
-                    self.sockets.query_port.send_response(addr, res='SUCCESS', type='query-result', data=record)
-                    return
-            
-            self.began_query = False
-            self.sockets.query_port.send_response(addr, res='FAILURE', type='query-result')
+        batch = self.pending_batches.get(rid)
+        if not batch or key not in batch['waiting'] or key in batch['retried']:
+            return False
+
+        batch['retried'][key] = error
+        if len(batch['retrying']) == 0:
+            # One view check covers every key that fails while it is in flight
+            self.spawn(self.retry_batch(rid))
+        batch['retrying'].append(key)
+        return True
+
+    async def retry_batch(self, rid):
+        '''Check the view and send the failed keys of the batch to a replica they haven't been sent to'''
+        epoch = self.view['epoch'] if self.view else None
+        self.view_checked = 0
+        refreshed = await self.refresh_view()
+        batch = self.pending_batches.get(rid)
+        if not batch:
+            return
+        keys = [key for key in batch['retrying'] if key in batch['waiting']]
+        batch['retrying'] = []
+        if refreshed and self.view['epoch'] != epoch:
+            # A new membership, every replica in it is worth a try
+            batch['epoch'] = self.view['epoch']
+            for key in keys:
+                batch['tried'][key] = set()
+        untried = lambda key: any(node['username'] not in batch['tried'][key] for node in self.view_replicas(key))
+        unsent = [key for key in keys if not refreshed or not untried(key)]
+        self.send_batch(rid, [key for key in keys if key not in unsent])
+        for key in unsent:
+            self.batch_result(rid, key, None, batch['retried'][key])
+
+    def expire_query(self, rid):
+        '''Give up on a query that never got a result'''
+        pending = self.pending_queries.pop(rid, None)
+        if pending and pending['fallbacks']:
+            # The replica may be down, the next one holds the same records
+            print(f"\n\nQuery for {self.KEY_COLUMN} of {pending['key']}: no result after {self.REQUEST_TIMEOUT}s, trying the next replica\n")
+            self.send_query(pending['key'], pending['fallbacks'][0], pending['epoch'], pending['fallbacks'][1:])
+        elif pending:
+            self.view_checked = 0
+            self.metrics.inc('queries_completed_total', kind='query', result='timed_out')
+            print(f"\n\nQuery for {self.KEY_COLUMN} of {pending['key']}: no result after {self.REQUEST_TIMEOUT}s (request {rid})\n")
+
+    def set_view(self, view):
+        '''Keep the membership view from the server along with the ring to find owners with'''
+        dht = view['dht']
+        vnodes = dht[0].get('vnodes', 0) if dht else 0
+        self.view = {
+            'epoch': view['epoch'],
+            'dht': dht,
+            'ring': HashRing(dht, vnodes, self.hash_function) if vnodes else None,
+            # key -> nodes holding it for the hot keys query results have told us about
+            'hot': {}
+        }
+
+    def view_replicas(self, key):
+        '''The nodes holding the key according to the cached view, same rule as replicas() on the nodes'''
+        return replica_set(self.view['dht'], self.view['ring'], self.hash_function(key), self.view['hot'].get(key, self.REPLICATION))
+
+    def note_replicas(self, key, replicas):
+        '''Remember how many nodes hold a hot key so the reads of it are spread over all of them'''
+        if self.view is None:
+            return
+        if replicas:
+            self.view['hot'][key] = replicas
         else:
-            # This isn't the correct node for query
-            self.query = ' '.join(long_name)
-            self.connect_query_nodes(addr)
+            self.view['hot'].pop(key, None)
+
+    async def refresh_view(self):
+        '''
+            Check the view with the server once it is older than VIEW_CHECK_INTERVAL
+            The server only sends the membership back when the epoch has changed
+        '''
+        if self.view and time.perf_counter() - self.view_checked < self.VIEW_CHECK_INTERVAL:
+            return True
+
+        command = f'get-view {self.user.username}'
+        if self.view:
+            command += f" {self.view['epoch']}"
+        try:
+            data_loaded = await self.request_server(command)
+        except asyncio.TimeoutError:
+            print(f"client: no response from the server to get-view after {self.REQUEST_TIMEOUT}s")
+            return self.view is not None
 
+        if data_loaded['res'] != 'SUCCESS':
+            if self.view and data_loaded['data'] == 'Stabilizing DHT':
+                # Nodes still forward queries sent off the old view while the DHT is rebuilt
+                return True
+            self.view = None
+            print(json.dumps(data_loaded, sort_keys=False, indent=4))
+            return False
+
+        if data_loaded['data']['dht'] is not None:
+            self.set_view(data_loaded['data'])
+        self.view_checked = time.perf_counter()
+        return True
 
-    def connect_query_nodes(self, origin, ip=None, port=None):
+    async def direct_query(self):
         '''
-            Connect to given query address or the query address of the next node
+            query-dht without asking the server for a random node, the query goes straight to a replica of the key
+            The replicas are tried in a random order so reads are spread over them
         '''
-        # This check will avoid looping through the nodes infinitely
-        if self.began_query and not ip:
-            self.began_query = False
-            self.sockets.query_port.send_response(origin, res='FAILURE', type='query-result')
+        if not await self.refresh_view():
             return
 
-        if self.query:
-            query_info = 'query ' + self.query
-            data = {
-                'data': query_info,
-                'origin': origin
+        query_long_name = await self.prompt(f"Enter query followed by the {self.KEY_COLUMN} to query: ")
+        key = ' '.join(query_long_name.split()[1:])
+        if self.query_cache is not None and key in self.query_cache:
+            # The view is only checked every VIEW_CHECK_INTERVAL and the key may have moved since it was cached
+            self.view_checked = 0
+            if not await self.refresh_view():
+                return
+        # Left at 0 when the DHT is being rebuilt, the epoch can't be confirmed so the cache is skipped
+        if self.view_checked and self.answer_from_cache(key):
+            return
+        replicas = self.view_replicas(key)
+        random.shuffle(replicas)
+        addrs = [(node['ip'], int(node['query'])) for node in replicas]
+        self.send_query(key, addrs[0], self.view['epoch'], addrs[1:])
+
+    def answer_from_cache(self, key):
+        '''
+            Print the result of a query this client has already had answered under the view's epoch
+            Queries go straight to a replica here so the entry node caches never see them, this is the only cache they hit
+        '''
+        if self.query_cache is None:
+            return False
+        start_time = time.perf_counter()
+        hit, record = self.query_cache.get(key, self.view['epoch'])
+        if not hit:
+            return False
+
+        self.metrics.inc('queries_answered_total', source='client-cache')
+        self.observe_query((time.perf_counter() - start_time) * 1000, 0, 'SUCCESS' if record else 'FAILURE')
+        if record:
+            print(f"\n\nQuery for {self.KEY_COLUMN} of {key}: (0 hops, cached here at epoch {self.view['epoch']})\n")
+            print(json.dumps(record, sort_keys=False, indent=4))
+        else:
+            print(f"\n\nQuery for {self.KEY_COLUMN} of {key}: 404 record not found (0 hops, cached here at epoch {self.view['epoch']})\n")
+        return True
+
+    def read_batch_keys(self, path):
+        '''Keys to query, one per line of the file or typed in until a blank line'''
+        if path:
+            with open(path, 'r') as key_file:
+                lines = key_file.read().splitlines()
+        else:
+            lines = []
+            while True:
+                line = input(f"Enter a {self.KEY_COLUMN} to query, or nothing to send the batch: ")
+                if not line.strip():
+                    break
+                lines.append(line)
+
+        # Each key is only asked for once
+        return list(dict.fromkeys(line.strip() for line in lines if line.strip()))
+
+    async def batch_query(self, keys):
+        '''
+            Query every key at once, grouped by the replica in the cached view each one is sent to
+            Each of those nodes gets one query-batch (split up only if it won't fit in a datagram) and streams
+            the results back, they are printed as they arrive with a summary once every key is answered
+        '''
+        if not keys:
+            print(f"\n\nNo {self.KEY_COLUMN} values to query\n")
+            return
+        if self.query_cache is not None and any(key in self.query_cache for key in keys):
+            # Confirm the epoch before serving cached results, a join, leave or repair may have moved the keys
+            self.view_checked = 0
+        if not await self.refresh_view():
+            return
+
+        rid = next(self.request_ids)
+        sent = time.perf_counter()
+        self.pending_batches[rid] = {
+            'waiting': dict.fromkeys(keys, sent),
+            'tried': {key: set() for key in keys},
+            'keys': len(keys),
+            'nodes': set(),
+            'sent': sent,
+            'latencies': [],
+            'found': 0,
+            'not_found': 0,
+            'errors': 0,
+            'epoch': self.view['epoch'],
+            # key -> error of the keys that failed off a stale view and were sent again, and those waiting on the view check
+            'retried': {},
+            'retrying': [],
+            'timer': self.loop.call_later(self.REQUEST_TIMEOUT, self.expire_batch, rid)
+        }
+        cached = {}
+        if self.query_cache is not None and self.view_checked:
+            for key in keys:
+                hit, record = self.query_cache.get(key, self.view['epoch'])
+                if hit:
+                    cached[key] = record
+        nodes = self.send_batch(rid, [key for key in keys if key not in cached])
+        print(f"\n\nQuerying {len(keys) - len(cached)} keys from {nodes} nodes, {len(cached)} cached here (request {rid})\n")
+        for key, record in cached.items():
+            self.metrics.inc('queries_answered_total', source='client-cache')
+            self.batch_result(rid, key, record)
+
+    def send_batch(self, rid, keys):
+        '''
+            Send each key to a replica it hasn't been sent to yet, picked at random to spread the reads
+            Returns how many nodes were sent keys, 0 once every replica of every key has been tried
+            or the view was dropped because the server has no DHT any more
+        '''
+        batch = self.pending_batches[rid]
+        if self.view is None:
+            return 0
+        nodes = {}
+        for key in keys:
+            replicas = [node for node in self.view_replicas(key) if node['username'] not in batch['tried'][key]]
+            if replicas:
+                node = random.choice(replicas)
+                batch['tried'][key].add(node['username'])
+                nodes.setdefault(node['username'], (node, []))[1].append(key)
+        batch['nodes'].update(nodes)
+
+        for node, node_keys in nodes.values():
+            for part in self.split_datagrams(node_keys, lambda key: len(key.encode('utf-8')) + 3):
+                message = {
+                    'data': 'query-batch',
+                    'keys': part,
+                    'origin': self.user.query_addr,
+                    'rid': rid,
+                    'epoch': self.view['epoch']
+                }
+                try:
+                    self.sockets.query_port.send_message(message, (node['ip'], int(node['query'])))
+                except:
+                    print("client-node: sendall() error within query connection")
+
+        return len(nodes)
+
+    def batch_result(self, rid, key, record, error=None, hops=None):
+        '''Print the result for one key of a batch, once the last key is in print the summary'''
+        batch = self.pending_batches.get(rid)
+        if not batch or key not in batch['waiting']:
+            return
+
+        latency = (time.perf_counter() - batch['waiting'].pop(key)) * 1000
+        batch['latencies'].append(latency)
+        if self.query_cache is not None and not error:
+            self.query_cache.put(key, record, batch['epoch'])
+        # Keys sent straight to a replica from the view are answered without a hop, forwarded ones come back as query results
+        self.observe_query(latency, hops or 0, 'SUCCESS' if record else 'FAILURE', error, 'batch')
+        if error:
+            batch['errors'] += 1
+            print(f"\t{key}: {error} ({latency:.1f} ms)")
+        elif record:
+            batch['found'] += 1
+            print(f"\t{key}: {json.dumps(record)} ({latency:.1f} ms)")
+        else:
+            batch['not_found'] += 1
+            print(f"\t{key}: 404 record not found ({latency:.1f} ms)")
+
+        batch['timer'].cancel()
+        if batch['waiting']:
+            # Results are still streaming in so only time out once they stop
+            batch['timer'] = self.loop.call_later(self.REQUEST_TIMEOUT, self.expire_batch, rid)
+        else:
+            self.finish_batch(rid)
+
+    def observe_query(self, latency, hops, res, error=None, kind='query'):
+        '''Count a query answered here by how it turned out and add its latency and hops to the histograms'''
+        outcome = 'error' if error else 'found' if res == 'SUCCESS' else 'not_found'
+        self.metrics.inc('queries_completed_total', kind=kind, result=outcome)
+        self.metrics.observe('query_latency_ms', latency, kind=kind)
+        self.metrics.observe('query_hops', hops, kind=kind)
+
+    def expire_batch(self, rid):
+        '''Nothing has come back for a while, try the keys still waiting on their other replicas or give up on them'''
+        batch = self.pending_batches.get(rid)
+        if batch:
+            self.view_checked = 0
+            if self.send_batch(rid, list(batch['waiting'])):
+                print(f"\tNo results for {len(batch['waiting'])} keys after {self.REQUEST_TIMEOUT}s, trying other replicas")
+                batch['timer'] = self.loop.call_later(self.REQUEST_TIMEOUT, self.expire_batch, rid)
+                return
+            self.metrics.inc('queries_completed_total', len(batch['waiting']), kind='batch', result='timed_out')
+            for key in batch['waiting']:
+                print(f"\t{key}: no result after {self.REQUEST_TIMEOUT}s")
+            self.finish_batch(rid)
+
+    def finish_batch(self, rid):
+        '''Print the latency, throughput and counts of the batch'''
+        batch = self.pending_batches.pop(rid)
+        batch['timer'].cancel()
+        elapsed = time.perf_counter() - batch['sent']
+        latencies = sorted(batch['latencies'])
+        percentile = lambda fraction: latencies[min(int(len(latencies) * fraction), len(latencies) - 1)] if latencies else 0
+
+        print(f"\n\nBatch query {rid}: {batch['keys']} keys from {len(batch['nodes'])} nodes in {elapsed:.3f}s "
+              f"({len(latencies) / elapsed:.0f} results/sec)")
+        print(f"\t{batch['found']} found, {batch['not_found']} not found, {batch['errors']} errors, "
+              f"{len(batch['waiting'])} timed out")
+        print(f"\tLatency per key p50 {percentile(0.5):.1f} ms, p90 {percentile(0.9):.1f} ms, "
+              f"p99 {percentile(0.99):.1f} ms, max {percentile(1):.1f} ms\n")
+
+    def run_batch(self, batch):
+        '''
+            Answer every key of the batch this node holds a copy of in as few datagrams as they fit in
+            Keys held somewhere else, the client's view was out of date, go on as single queries
+        '''
+        origin = tuple(batch['origin'])
+        results = []
+        for key in batch['keys']:
+            key_hash = self.hash_function(key)
+            replicas = self.replicas(key_hash) if self.user.id is not None else []
+            query = {
+                'data': 'query',
+                'key': key,
+                'origin': origin,
+                'rid': batch['rid'],
+                'hops': 0,
+                'ttl': self.QUERY_TTL,
+                'epoch': batch.get('epoch')
             }
-            data_loaded = json.dumps(data)
-            query = bytes(data_loaded, 'utf-8')
-            
+            if any(node['id'] == self.user.id for node in replicas):
+                result = self.read_local(key, key_hash, replicas)
+                if result['record'] is not None or not self.ask_previous_holder(query, key_hash):
+                    results.append(result)
+            else:
+                self.run_query(query)
+
+        for part in self.split_datagrams(results, lambda result: len(json.dumps(result)) + 2):
+            self.sockets.query_port.send_response(origin, res='SUCCESS', type='batch-result', data={'results': part}, rid=batch['rid'])
+
+    def split_datagrams(self, items, size_of):
+        '''Split the items into parts that each fit in a datagram, size_of gives the bytes an item takes up'''
+        parts = [[]]
+        # Leave room for the rest of the message around the items
+        size = 200
+        for item in items:
+            item_size = size_of(item)
+            if parts[-1] and size + item_size > self.BUFFER_SIZE:
+                parts.append([])
+                size = 200
+            parts[-1].append(item)
+            size += item_size
+
+        return parts if parts[-1] else []
+
+    def scatter_find(self, data_loaded):
+        '''Fan the find out to every node in the DHT at once, each of them answers the origin directly'''
+        data_loaded['data'] = 'find-local'
+        find_local = wire.encode(data_loaded, self.WIRE_FORMAT)
+        for node in self.user.dht:
             try:
-                if ip:
-                    # print(f'sending query info {data_loaded} to address {ip}, {port}')
-                    self.began_query = True
-                    self.sockets.query_port.socket.sendto(query, (ip, port))
-                else:
-                    # print(f'sending query info {data_loaded} to address {self.user.next_node_query_addr}')
-                    self.sockets.query_port.socket.sendto(query, self.user.next_node_query_addr)
-                # Sent query now listening for response from next node!
+                self.sockets.query_port.count_message('sent', 'find-local')
+                self.sockets.query_port.sendto(find_local, (node['ip'], int(node['query'])))
             except:
-                print("client-node: sendall() error within query connection")
-                return
+                print("client-node: sendall() error within find scatter")
+
+    def send_find_results(self, origin, rid, records):
+        '''Send the matching records back to the origin, split into as many datagrams as it takes to fit them'''
+        # Every node answers even with no matches so the origin knows it has heard from all of them
+        parts = self.split_datagrams(records, lambda record: len(json.dumps(record)) + 2) or [[]]
+
+        for part, part_records in enumerate(parts):
+            result = {
+                'id': self.user.id,
+                'n': self.user.n,
+                'part': part,
+                'parts': len(parts),
+                'records': part_records
+            }
+            self.sockets.query_port.send_response(origin, res='SUCCESS', type='find-result', data=result, rid=rid)
+
+    def gather_find_result(self, data_loaded):
+        '''Merge a part of the find results, once every node has answered in full print them all'''
+        result = data_loaded['data']
+        find = self.pending_finds.get(data_loaded.get('rid'))
+        if not find:
+            return
+
+        find['records'].extend(result['records'])
+        find['n'] = result['n']
+        find['parts'].setdefault(result['id'], set()).add(result['part'])
+        find['expected'][result['id']] = result['parts']
 
+        find['timer'].cancel()
+        if len(find['expected']) < find['n'] or any(len(find['parts'][id]) < parts for id, parts in find['expected'].items()):
+            # Parts are still coming in so only give up on the rest once they stop
+            find['timer'] = self.loop.call_later(self.REQUEST_TIMEOUT, self.expire_find, data_loaded['rid'])
+            return
+        del self.pending_finds[data_loaded['rid']]
+
+        records = sorted(find['records'], key=lambda record: record[self.KEY_COLUMN])
+        print(f"\n\nFind for {find['column']} of {find['value']}: {len(records)} records from {find['n']} nodes\n")
+        print(json.dumps(records, sort_keys=False, indent=4))
+
+    def expire_find(self, rid):
+        '''Give up on the nodes that haven't answered the find in full and print what did come back'''
+        find = self.pending_finds.pop(rid, None)
+        if not find:
+            return
+
+        records = sorted(find['records'], key=lambda record: record[self.KEY_COLUMN])
+        if find['n'] is None:
+            missing = 'every node'
         else:
-            failure_res = "missing query be sure to put 'query {Long Name}' in your query command"
-            self.sockets.query_port.send_response(origin, res='FAILURE', type='query-result', data=failure_res)
+            complete = [id for id, parts in find['expected'].items() if len(find['parts'][id]) == parts]
+            missing = 'node ids ' + ', '.join(str(id) for id in range(find['n']) if id not in complete)
+        print(f"\n\nFind for {find['column']} of {find['value']}: {len(records)} records so far, "
+              f"no answer from {missing} after {self.REQUEST_TIMEOUT}s (request {rid})\n")
+        print(json.dumps(records, sort_keys=False, indent=4))
 
-    def connect_all_nodes(self):
-        i = 1
+    def run_query(self, query):
+        '''
+            Take in the query message and either return response with record found
+            or forward the same message towards a node holding a copy, nothing about the query is kept on this node
+        '''
+        origin = tuple(query['origin'])
+        if self.user.id is None:
+            # Client sent the query off an old view and this node has left the DHT since
+            result = {'key': query['key'], 'record': None, 'hops': query['hops'], 'error': 'node is no longer maintaining the DHT'}
+            self.sockets.query_port.send_response(origin, res='FAILURE', type='query-result', data=result, rid=query['rid'])
+            return
 
-        while i < len(self.user.dht):
-            j = i - 1
-            if i + 1 < len(self.user.dht):
-                data = (self.user.dht[j], self.user.dht[i], self.user.dht[i+1])
-            else:
-                data = (self.user.dht[j], self.user.dht[i], self.user.dht[0])
-            # print("Sending data: ", data)
+        if query.get('previous'):
+            # Sent on by a node that holds the key now but hasn't been handed it yet, answer from the store as is
+            record = self.local_store.get(query['key'])
+            result = {'key': query['key'], 'record': record, 'hops': query['hops']}
+            self.sockets.query_port.send_response(origin, res='SUCCESS' if record else 'FAILURE', type='query-result', data=result, rid=query['rid'])
+            return
+
+        key_hash = self.hash_function(query['key'])
+        replicas = self.replicas(key_hash)
+        if any(node['id'] == self.user.id for node in replicas):
+            # This node holds a copy of the record
+            result = self.read_local(query['key'], key_hash, replicas)
+            result['hops'] = query['hops']
+            record = result['record']
+            if record is None and self.ask_previous_holder(query, key_hash):
+                return
+            self.sockets.query_port.send_response(origin, res='SUCCESS' if record else 'FAILURE', type='query-result', data=result, rid=query['rid'])
+            if query.get('entry'):
+                # Let the node the query came in at cache the answer, not found included
+                cache_data = {'key': query['key'], 'record': record, 'epoch': query['epoch']}
+                self.sockets.query_port.send_response(tuple(query['entry']), res='SUCCESS', type='query-cache', data=cache_data)
+            return
+
+        if self.query_cache is not None and query['hops'] == 0:
+            # Queries enter the DHT here so this node can answer the popular ones without going to the owner
+            hit, record = self.query_cache.get(query['key'], query.get('epoch'))
+            if hit:
+                self.metrics.inc('queries_answered_total', source='cache')
+                result = {'key': query['key'], 'record': record, 'hops': 0, 'cached': True}
+                self.sockets.query_port.send_response(origin, res='SUCCESS' if record else 'FAILURE', type='query-result', data=result, rid=query['rid'])
+                return
+            if query.get('epoch') is not None:
+                query['entry'] = self.user.query_addr
+
+        if query['ttl'] <= 0:
+            # Stops a query from going around forever if the membership is changing underneath it
+            result = {'key': query['key'], 'record': None, 'hops': query['hops'], 'error': 'query TTL expired'}
+            self.sockets.query_port.send_response(origin, res='FAILURE', type='query-result', data=result, rid=query['rid'])
+            return
+
+        # This isn't the correct node for query so jump as far towards one of the replicas as the finger table allows
+        # The replica is picked at random where the query comes in so reads of a popular key are spread over its copies,
+        # it goes on the message so every hop heads for the same node and the route stays O(log n)
+        id = query.get('target')
+        if id not in (node['id'] for node in replicas):
+            id = query['target'] = random.choice(replicas)['id']
+        finger = closest_finger(self.user.finger_table, self.user.id, id, self.user.n)
+        next_addr = (finger['ip'], int(finger['query'])) if finger else self.user.next_node_query_addr
+        query['hops'] += 1
+        query['ttl'] -= 1
+        self.metrics.inc('queries_forwarded_total')
+        try:
+            self.sockets.query_port.send_message(query, next_addr)
+        except:
+            print("client-node: sendall() error within query connection")
+
+    def start_migration(self):
+        '''A join has started moving records, keep the old ring around to find where they were'''
+        self.migrating = True
+        old_dht = self.user.previous_dht
+        self.previous_ring = HashRing(old_dht, self.ring.vnodes, self.hash_function) if self.ring and old_dht else None
+
+    def ask_previous_holder(self, query, key_hash):
+        '''
+            While a join is moving records send a query missed here on to a node that held the key before
+            Returns False when there is nobody to ask, this node held the key before too so the miss is real
+        '''
+        if not self.migrating or not self.user.previous_dht:
+            return False
+        old_holders = replica_set(self.user.previous_dht, self.previous_ring, key_hash, self.REPLICATION)
+        if any(node['username'] == self.user.username for node in old_holders):
+            return False
+
+        node = random.choice(old_holders)
+        query['previous'] = True
+        query['hops'] += 1
+        self.metrics.inc('queries_forwarded_total')
+        try:
+            self.sockets.query_port.send_message(query, (node['ip'], int(node['query'])))
+        except:
+            print("client-node: sendall() error within query connection")
+        return True
+
+    def read_local(self, key, key_hash, replicas):
+        '''
+            Look up a key held here for a query, counting the read if this node owns the key
+            The result tells the client how many nodes hold the key when it is hot
+        '''
+        if self.hot_keys is not None and replicas[0]['id'] == self.user.id:
+            # Reads are spread evenly over the replicas so this one stands for that many
+            if self.hot_keys.record(key, len(replicas)):
+                replicas = self.promote_key(key, key_hash)
+
+        self.metrics.inc('queries_answered_total', source='store')
+        result = {'key': key, 'record': self.local_store.get(key)}
+        if len(replicas) > self.REPLICATION:
+            result['replicas'] = len(replicas)
+        return result
+
+    def promote_key(self, key, key_hash):
+        '''Spread a hot key owned here over HOT_REPLICAS more successors and let every node know, returns its replicas'''
+        replicas = self.replicas(key_hash)
+        self.hot_replicas[key_hash] = min(self.REPLICATION + self.HOT_REPLICAS, self.user.n)
+        hot_replicas = self.replicas(key_hash)
+        record = self.local_store.get(key)
+        if record:
+            for node in hot_replicas[len(replicas):]:
+                self.batcher.add((node['ip'], int(node['port'])), record, type='handoff')
+            self.batcher.flush_all()
+
+        # Sent after the record on the same channel so no node hears it is a replica before it has the copy
+        self.announce_hot_key(key, len(hot_replicas))
+        print(f"hot-keys: {key} is hot, spread over {len(hot_replicas)} nodes\n")
+        return hot_replicas
+
+    def demote_key(self, key):
+        '''Take a key that has cooled off back to its usual replicas'''
+        if self.hot_replicas.pop(self.hash_function(key), None) is None:
+            return
+
+        self.announce_hot_key(key, self.REPLICATION)
+        print(f"hot-keys: {key} has cooled off, back on {self.REPLICATION} nodes\n")
+
+    def announce_hot_key(self, key, replicas):
+        '''Tell every other node how many nodes hold the key'''
+        for node in self.user.dht:
+            if node['username'] != self.user.username:
+                self.sockets.send_port.send_response(addr=(node['ip'], int(node['port'])), res='SUCCESS', type='hot-key', data={'key': key, 'replicas': replicas})
+
+    def set_hot_key(self, key, replicas):
+        '''The owner of the key spread it out or took it back in, extra copies held here are dropped once it cools off'''
+        key_hash = self.hash_function(key)
+        if replicas > self.REPLICATION:
+            self.hot_replicas[key_hash] = replicas
+            return
+
+        self.hot_replicas.pop(key_hash, None)
+        if self.user.id is not None and not self.holds(key_hash):
+            self.local_store.remove(key)
+
+    async def hot_key_loop(self):
+        '''Every HOT_KEY_WINDOW seconds decay the sketch and take the keys that have cooled off back in'''
+        while not self.terminated:
+            await asyncio.sleep(self.HOT_KEY_WINDOW)
+            for key in self.hot_keys.decay():
+                if self.user.id is not None:
+                    self.demote_key(key)
+
+    async def fan_out(self, type, messages):
+        '''
+            Send every (node, data) message at once from the send port and wait for all of the acks
+            Returns {username: reason} for every node that didn't ack
+        '''
+        async def send(node, data):
             try:
-                print(f'sending message to addr: ({self.user.dht[i]["ip"]}, {self.user.dht[i]["port"]})')
-                self.sockets.send_port.send_response(addr=(self.user.dht[i]['ip'], int(self.user.dht[i]['port'])), res='SUCCESS', type='set-id', data=data)
-                self.sockets.send_port.socket.recv(self.BUFFER_SIZE)
-                print(f"Successfully sent set-id command to {self.user.dht[i]['username']}")
+                await self.sockets.send_port.request((node['ip'], int(node['port'])), 'SUCCESS', type, data, self.REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
+                return f"no ack after {self.REQUEST_TIMEOUT}s"
             except Exception as error:
-                print(error)
-                print('An exception occurred sending node connection data')
-            
-            i += 1
+                return str(error)
 
-    def convert_neighbors(self):
-        reset_right_data = self.user.prev_node_addr
+        start_time = time.perf_counter()
+        results = await asyncio.gather(*(send(node, data) for node, data in messages))
+        failures = {node['username']: error for (node, _), error in zip(messages, results) if error}
 
-        # Send the reset-right command and await a response
-        self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='reset-right', data=reset_right_data)
-        res = self.sockets.send_port.socket.recv(self.BUFFER_SIZE)
+        elapsed = (time.perf_counter() - start_time) * 1000
+        print(f"{type} acked by {len(messages) - len(failures)} of {len(messages)} nodes in {elapsed:.1f} ms")
+        for username, error in failures.items():
+            print(f"\t{type} failed for {username}: {error}")
 
-        # Check for success message from res
-        data_loaded = res.decode('utf-8')
-        # print(f'REset right sent back {data_loaded}')
-        self.new_leader = data_loaded
+        return failures
+
+    async def connect_all_nodes(self):
+        '''Send every other node its neighbours and the membership list, all of them at once'''
+        dht = self.user.dht
+        messages = []
+        for i in range(1, len(dht)):
+            # Every node gets the full membership list so it can build its finger table
+            data = {
+                'nodes': (dht[i - 1], dht[i], dht[(i + 1) % len(dht)]),
+                'dht': dht
+            }
+            messages.append((dht[i], data))
+
+        return await self.fan_out('set-id', messages)
+
+    async def teardown_all(self):
+        '''Leader only, tell every other node to tear down at once then do the same here and let the server know'''
+        await self.fan_out('teardown', [(node, None) for node in self.user.dht if node['username'] != self.user.username])
+        self.teardown_dht(False)
+        await self.send_command(f'teardown-complete {self.user.username}')
+
+    def pull_records(self):
+        '''
+            Ask the nodes holding the records this node now owns to stream them over
+            With a hash ring those are just the nodes holding the arcs this node took over
+        '''
+        old_dht = self.user.previous_dht
+        if self.ring and self.REPLICATION == 1:
+            holders = self.previous_ring.arc_holders(self.user.username)
+        else:
+            # pos % n changes for every node so all of them may hold records owned here, and with replicas
+            # every node whose successors changed has copies to move or drop
+            holders = old_dht
+
+        self.pending_pulls = set(node['username'] for node in holders)
+        print(f"Pulling records from {', '.join(sorted(self.pending_pulls))}\n")
+        for node in holders:
+            self.sockets.send_port.send_response(addr=(node['ip'], int(node['port'])), res='SUCCESS', type='pull-records', data=self.user.accept_port_address)
+
+    async def leave_dht(self, new_dht):
+        '''
+            Every other node has taken on the new membership, so stream the records held here
+            to the nodes that inherit them and let the server know the DHT is rebuilt
+        '''
+        # Route with the new membership, this node isn't part of it so every record gets handed off
+        self.user.previous_dht = self.user.dht
+        self.user.dht = new_dht
+        self.user.id = None
+        self.user.n = len(new_dht)
+        self.set_routing()
+        moved = await self.rehome_records()
+        print(f"Handed off {moved} records\n")
+
+        self.teardown_dht(False)
+        self.leaving_user = False
+        await self.send_command(f'dht-rebuilt {self.user.username} {new_dht[0]["username"]}')
+
+    async def heartbeat_loop(self):
+        '''
+            Ping the successor every HEARTBEAT_INTERVAL seconds, once it misses HEARTBEAT_MISSES in a row
+            it is taken to have failed and is spliced out of the DHT
+        '''
+        watching = None
+        misses = 0
+        while not self.terminated:
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+            if self.user.id is None or not self.user.successors or self.leaving_user or self.joining_user:
+                # Nodes that are leaving or joining have a membership out of step with their neighbors
+                watching = None
+                continue
+
+            successor = self.user.successors[0]
+            if successor['username'] != watching:
+                watching = successor['username']
+                misses = 0
+            try:
+                response = await self.sockets.query_port.request((successor['ip'], int(successor['query'])), 'SUCCESS', 'heartbeat',
+                                                                 {'username': self.user.username}, self.HEARTBEAT_INTERVAL, 'heartbeat-ack')
+            except asyncio.TimeoutError:
+                misses += 1
+                if misses >= self.HEARTBEAT_MISSES and await self.splice_successor(successor):
+                    watching = None
+                continue
+
+            misses = 0
+            if response['res'] != 'SUCCESS' and self.user.id is not None:
+                # The rest of the DHT already spliced this node out, its records are held elsewhere now
+                print(f"heartbeat: {response['data']}, tearing down the local DHT\n")
+                self.teardown_dht(False)
+
+    def answer_heartbeat(self, data_loaded, addr):
+        '''
+            Answer the predecessor's heartbeat, telling it if this node knows it has been spliced out of the DHT
+            A node that isn't maintaining, say one restarted without its snapshot, stays quiet so it is spliced out
+        '''
+        if self.user.id is None:
+            return
+
+        username = data_loaded['data']['username']
+        if all(node['username'] != username for node in self.user.dht):
+            self.sockets.query_port.send_response(addr, res='FAILURE', type='heartbeat-ack', data=f"{username} is no longer in the DHT", rid=data_loaded.get('rid'))
+        else:
+            self.sockets.query_port.send_response(addr, res='SUCCESS', type='heartbeat-ack', rid=data_loaded.get('rid'))
+
+    async def splice_successor(self, failed):
+        '''
+            Route around the failed successor straight away, then have the server take it out of the DHT
+            and hand the new membership to every node left so they can move the records it held
+            Returns False if the server wouldn't take it out, the next missed heartbeat tries again
+        '''
+        print(f"heartbeat: {failed['username']} missed {self.HEARTBEAT_MISSES} heartbeats, splicing it out of the DHT")
+        if len(self.user.successors) > 1:
+            next_node = self.user.successors[1]
+            self.user.next_node_addr = (next_node['ip'], int(next_node['port']))
+            self.user.next_node_query_addr = (next_node['ip'], int(next_node['query']))
+
+        try:
+            data_loaded = await self.request_server(f"node-failed {self.user.username} {failed['username']}")
+        except asyncio.TimeoutError:
+            print(f"heartbeat: no response from the server to node-failed after {self.REQUEST_TIMEOUT}s")
+            return False
+        if data_loaded['res'] != 'SUCCESS':
+            print(f"heartbeat: {failed['username']} wasn't spliced out, {data_loaded['data']}")
+            return False
+
+        dht = data_loaded['data']['dht']
+        data = {'dht': dht, 'failed': failed['username']}
+        await self.fan_out('repair', [(node, data) for node in dht if node['username'] != self.user.username])
+        await self.repair_membership(dht, failed['username'])
+        if self.REPLICATION == 1:
+            print(f"heartbeat: REPLICATION is 1 so the records {failed['username']} owned are lost")
+        return True
+
+    async def repair_membership(self, dht, failed):
+        '''Take on the membership without the failed node and move the records it held to their new holders'''
+        self.adopt_membership(dht)
+        moved = await self.rehome_records(lost={failed})
+        print(f"{failed} failed and was spliced out of the DHT, node ID is now {self.user.id} of {self.user.n}, handed off {moved} records\n")
 
-        reset_left_data = {
-            'current': self.user.accept_port_address,
-            'new': self.user.next_node_addr,
-            'query': self.user.next_node_query_addr
-        }
-        
-        self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='reset-left', data=reset_left_data)        
-        
     def check_nodes(self):
         self.started_check = True
         self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='check-nodes')
 
-    def listen(self):
+    def server_datagram(self, data, addr):
+        '''Responses the socket couldn't match to a waiting command, anything without a request id is just listened to'''
+        try:
+            data_loaded = wire.decode(data)
+        except (ValueError, UnicodeDecodeError) as error:
+            print(f"client: unreadable response from the server, {error}")
+            return
+        self.sockets.client_to_server.count_message('received', wire.message_name(data_loaded))
+
+        if data_loaded.get('rid') is not None:
+            # Answers a command that already timed out, acting on it now would mix it up with whatever came since
+            print(f"client: ignoring late {data_loaded.get('type')} response from the server (request {data_loaded['rid']})")
+            return
+        self.spawn(self.listen(data_loaded))
+
+    async def request_server(self, command):
+        '''Send the command string to the server and wait for the response carrying its request id'''
+        start_time = time.perf_counter()
+        response = await self.sockets.client_to_server.command(self.user.server_addr, command, self.REQUEST_TIMEOUT)
+        name = command.split()[0] if command.split() else 'none'
+        self.metrics.observe('server_request_ms', (time.perf_counter() - start_time) * 1000, command=name)
+        return response
+
+    async def send_command(self, command):
+        '''Send the command to the server and listen to the response'''
+        try:
+            data_loaded = await self.request_server(command)
+        except asyncio.TimeoutError:
+            print(f"client: no response from the server to {command.split()[0]} after {self.REQUEST_TIMEOUT}s")
+            return
+
+        await self.listen(data_loaded)
+
+    async def prompt(self, message):
+        '''Read a line of input without blocking the event loop'''
+        return await self.loop.run_in_executor(None, input, message)
+
+    async def listen(self, data_loaded):
         '''
-            Listen function that will listen to all responses from the server connected to self
+            Listen function that will handle the responses from the server connected to self
         '''
-        
-        data = self.sockets.client_to_server.socket.recv(self.BUFFER_SIZE)
-        data_loaded = data.decode('utf-8')
-
-        if data_loaded:
-            try:
-                data_loaded = json.loads(data_loaded)
-            except:
-                print("error with json.load")
-                return
-        
         print("\n\n")
-        if data_loaded and data_loaded['res'] == 'SUCCESS':
+        if data_loaded['res'] == 'SUCCESS':
             if data_loaded['data']:
                 print(json.dumps(data_loaded, sort_keys=False, indent=4))
             
             if data_loaded['type'] == 'DHT':
                 self.set_data(data_loaded['data'], index=-1)
-                self.connect_all_nodes()
+                await self.connect_all_nodes()
                 # Call setup all dht but set the input printer var to false
-                self.setup_all_local_dht(False)
-                success_string = bytes(f'dht-complete {self.user.username}', 'utf-8')
-                try:
-                    self.sockets.client_to_server.socket.sendto(success_string, self.user.server_addr)
-                    self.listen()
-                except:
-                    print("client: sendall() error sending success string")
-                    return
+                await self.setup_all_local_dht(False)
+                await self.send_command(f'dht-complete {self.user.username}')
             elif data_loaded['type'] == 'query-response':
-                query_long_name = input("Enter query followed by the Long Name to query: ")
-                self.query = ' '.join(query_long_name.split()[1:])
-                # print(f"Received query of {self.query}")
+                query_long_name = await self.prompt(f"Enter query followed by the {self.KEY_COLUMN} to query: ")
                 first_ip = data_loaded['data']['ip']
                 first_port = int(data_loaded['data']['query'])
-                self.connect_query_nodes(origin=self.user.query_addr, ip=first_ip, port=first_port)
-                # print(response)
+                self.send_query(' '.join(query_long_name.split()[1:]), (first_ip, first_port), data_loaded['data'].get('epoch'))
+            elif data_loaded['type'] == 'find-response':
+                find_input = await self.prompt("Enter the column followed by = and the value to find: ")
+                if '=' not in find_input:
+                    print("\n\nThe find needs to look like ⟨column⟩ = ⟨value⟩\n")
+                    return
+                column, value = find_input.split('=', 1)
+                rid = next(self.request_ids)
+                self.pending_finds[rid] = {
+                    'column': column.strip(),
+                    'value': value.strip(),
+                    'n': None,
+                    'parts': {},
+                    'expected': {},
+                    'records': [],
+                    # Results come back as plain UDP, don't wait forever on one that was lost or a node that died
+                    'timer': self.loop.call_later(self.REQUEST_TIMEOUT, self.expire_find, rid)
+                }
+                find_data = {
+                    'data': 'find',
+                    'column': column.strip(),
+                    'value': value.strip(),
+                    'origin': self.user.query_addr,
+                    'rid': rid
+                }
+                # The entry node fans the find out to every node so it only has to be sent once
+                self.sockets.query_port.send_message(find_data, (data_loaded['data']['ip'], int(data_loaded['data']['query'])))
             elif data_loaded['type'] == 'join-response':
                 self.joining_user = True
                 self.user.username = data_loaded['data']['username']
@@ -516,22 +1623,24 @@ class Client:
                 
                 new_data = {
                     'username': self.user.username,
-                    'n': 0,
                     'addr': self.user.accept_port_address,
                     'query': self.user.query_addr
                 }
 
-                # print('Teardown complete now calling reset-n\n')
                 self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='reset-n', data=new_data)
             elif data_loaded['type'] == 'deregister':
                 self.end_script(f"{data_loaded['data']}\nTerminating client application.")
             elif data_loaded['type'] == 'leave-response':
                 self.leaving_user = True
-                self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='leaving-teardown')
+                # Only this node's records have to move, so start the reset-id pass with the new membership list
+                reset_id_data = {
+                    'dht': leave_membership(self.user.dht, self.user.username)
+                }
+                self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='reset-id', data=reset_id_data)
             elif data_loaded['type'] == 'teardown-response':
                 # Need to be on the leader node for this to work
                 if self.user.id == 0:
-                    self.sockets.send_port.send_response(addr=self.user.next_node_addr, res='SUCCESS', type='teardown')
+                    await self.teardown_all()
                 else:
                     print("\n\nCan't run this command since this is not the leader node\n")
         else:
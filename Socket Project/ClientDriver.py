@@ -22,16 +22,40 @@ Usage:
 
 
 from Client import Client
+import os
 import sys
 import time
 
 
-HASH_SIZE = 353 # Size to initialize the local hash table to
-BUFFER_SIZE = 4096 # Max bytes to take in
-FILE_PATH = "StatsCountry.csv"
-ALL_COMMANDS = ['leave-dht', 'join-dht', 'query-dht', 'deregister', 'teardown-dht', 'register', 'setup-dht']
-DEBUGGING_COMMANDS = ['check-node', 'help', 'display-users']
-BASIC_COMMANDS = ['leave-dht', 'join-dht', 'query-dht', 'deregister', 'teardown-dht']
+BUFFER_SIZE = 65507 # Max bytes to take in, the largest payload a UDP datagram can carry
+FILE_PATH = "StatsCountry.csv" # Relative to this script or an absolute path, read in chunks so it can be any size
+KEY_COLUMN = "Long Name" # Column the records are stored and queried by, must match on every node
+LOAD_COLUMNS = None # Columns kept from the file, None keeps all of them, the key column is always kept
+LOAD_MODE = "direct" # 'direct' sends each record straight to its owner, 'ring' forwards it node by node
+BATCH_SIZE = 32 # Max records packed into one records datagram, 1 sends every record on its own
+BATCH_BYTES = 8192 # Max bytes of a records datagram, can't be more than BUFFER_SIZE
+HASH_FUNCTION = "blake2b" # Key hash used for buckets and owners: 'ascii', 'fnv1a' or 'blake2b', must match on every node
+INDEX_COLUMNS = ['Region', 'Currency Unit', 'Country Code', '2-Alpha Code'] # Columns every node keeps a secondary index on
+QUERY_TTL = 16 # Max hops a query can take before it is answered with a failure
+REQUEST_TIMEOUT = 5.0 # Seconds to wait on a response from the server or another node
+WIRE_FORMAT = "binary" # "binary" frames or "json" for messages that can be read while debugging
+RELIABLE = True # Send node to node messages with acks and retransmission instead of fire and forget
+QUERY_CACHE = 1024 # Query results kept for queries entering the DHT at each node, and with ROUTING_CACHE for each client's own queries, 0 turns it off
+ROUTING_CACHE = True # Cache the DHT membership and send queries straight to the owner instead of a random node
+VIEW_CHECK_INTERVAL = 5.0 # Seconds before the cached membership is checked with the server again
+SNAPSHOT_DIR = "snapshots" # Where nodes save their records to restart without a reload, relative to this script, None turns it off
+SNAPSHOT_INTERVAL = 30.0 # Seconds between snapshots, only taken if the store has changed
+REPLICATION = 2 # Copies of each record, the owner plus its successors, has to match on every node
+HEARTBEAT_INTERVAL = 1.0 # Seconds between heartbeats to the successor, 0 turns failure detection off
+HEARTBEAT_MISSES = 3 # Heartbeats missed in a row before the successor is spliced out of the DHT
+SUCCESSORS = 3 # Length of the successor list each node keeps to route around a failed successor
+HOT_KEY_THRESHOLD = 200 # Reads of a key, halved every HOT_KEY_WINDOW seconds, before its owner spreads it out, 0 turns it off
+HOT_KEY_WINDOW = 10.0 # Seconds between halving the read counts, a hot key cools off once under half the threshold
+HOT_REPLICAS = 2 # Extra successors a hot key is copied to for reads
+METRICS_DIR = None # Serve each node's metrics to Prometheus on METRICS_DIR/<username>.sock, relative to this script, None turns it off
+ALL_COMMANDS = ['leave-dht', 'join-dht', 'query-dht', 'query-batch', 'find-dht', 'snapshot', 'deregister', 'teardown-dht', 'register', 'setup-dht']
+DEBUGGING_COMMANDS = ['check-node', 'stats', 'help', 'display-users', 'display-dht']
+BASIC_COMMANDS = ['leave-dht', 'join-dht', 'query-dht', 'find-dht', 'deregister', 'teardown-dht']
 
 
 def read_input(client):
@@ -47,8 +71,20 @@ All Commands:
     
     - query-dht
         This command is used to initiate a query of the DHT.
+
+    - query-batch [file]
+        This command queries every Long Name in the file, one per line, or typed in until a blank line.
+        The Long Names are grouped by the node that owns them and the results printed as they arrive.
+
+    - find-dht
+        This command finds every record whose column matches a value, e.g. Region = South Asia.
+        Every node in the DHT is searched at once.
     
     - leave-dht
+
+    - snapshot
+        This command saves the records this node holds to disk along with the DHT epoch.
+        A node restarted while the DHT is still at that epoch loads them back instead of being sent them again.
     
     - deregister
         This command removes the state of a this user from the state information base (if already Free), allowing it to terminate. 
@@ -63,7 +99,12 @@ Debugging Commands:
     - check-node
         This command while output important information about the current node
 
+    - stats
+        This command prints the message counters, bytes in and out, queue depths and the query latency and hop
+        histograms of this node, followed by the server's
+
     - display-users
+    - display-dht
         These commands will do as they sound and have the server desplay the respective database
     '''
     while True:
@@ -85,21 +126,33 @@ Debugging Commands:
                     string_to_serv = f'{command} {data_list[1]} {client.user.username}'
                 else:
                     string_to_serv = f'{command}'
-            # Send command to server
-            string_to_serv = bytes(string_to_serv, 'utf-8')
+            # Send command to server and wait for the client event loop to handle the response
             try:
-                client.sockets.client_to_server.socket.sendto(string_to_serv, client.user.server_addr)
-                client.listen()
+                if command == 'query-dht' and client.ROUTING_CACHE:
+                    client.run(client.direct_query())
+                elif command == 'snapshot':
+                    client.run(client.save_snapshot())
+                elif command == 'query-batch':
+                    client.run(client.batch_query(client.read_batch_keys(data_list[1] if len(data_list) > 1 else None)))
+                else:
+                    client.run(client.send_command(string_to_serv))
+            except OSError as error:
+                print(f"client: {error}")
             except Exception as error:
                 print(error)
                 print("client: sendall() error")
+            if client.terminated:
+                sys.exit()
         elif command in DEBUGGING_COMMANDS:
             if command == 'check-node':
                 client.output_node_info()
+            elif command == 'stats':
+                client.output_stats()
+                client.run(client.send_command(command))
             elif command == 'help':
                 print(read_input.__doc__)
             elif command == 'display-dht' or command == 'display-users':
-                client.sockets.client_to_server.socket.sendto(bytes(command, 'utf-8'), client.user.server_addr)
+                client.run(client.send_command(command))
         else:
             print("Invalid command! Send help if you need to see all valid commands.\n")
 
@@ -123,11 +176,21 @@ def main(args):
     query_port = int(args[6])
     right_port = int(args[7])
 
-    client = Client(username, serv_IP, echo_serv_port, client_IP, client_port, 
-                    query_port, right_port, HASH_SIZE, BUFFER_SIZE, FILE_PATH)
-
-
-    client.start_threads()
+    # Settings go by name so a new one can never shift the others along
+    client = Client(username, serv_IP, echo_serv_port, client_IP, client_port, query_port, right_port,
+                    buff_size=BUFFER_SIZE, file_path=FILE_PATH, load_mode=LOAD_MODE, batch_size=BATCH_SIZE,
+                    batch_bytes=BATCH_BYTES, hash_function=HASH_FUNCTION, index_columns=INDEX_COLUMNS,
+                    query_ttl=QUERY_TTL, request_timeout=REQUEST_TIMEOUT, wire_format=WIRE_FORMAT, reliable=RELIABLE,
+                    query_cache=QUERY_CACHE, routing_cache=ROUTING_CACHE, view_check_interval=VIEW_CHECK_INTERVAL,
+                    key_column=KEY_COLUMN, load_columns=LOAD_COLUMNS,
+                    snapshot_dir=os.path.join(sys.path[0], SNAPSHOT_DIR) if SNAPSHOT_DIR else None,
+                    snapshot_interval=SNAPSHOT_INTERVAL, replication=REPLICATION, heartbeat_interval=HEARTBEAT_INTERVAL,
+                    heartbeat_misses=HEARTBEAT_MISSES, successors=SUCCESSORS, hot_key_threshold=HOT_KEY_THRESHOLD,
+                    hot_key_window=HOT_KEY_WINDOW, hot_replicas=HOT_REPLICAS,
+                    metrics_endpoint=os.path.join(sys.path[0], METRICS_DIR, f'{username}.sock') if METRICS_DIR else None)
+
+
+    client.start()
 
     read_input(client)
 
@@ -7,36 +7,181 @@ Group: 85
 Ports: 4300 - 43499
 
 About:  Purpose of this project is to implement your own application program in which processes
-    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and 
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
     answer queries using it.
 
 ClientDriver.py:
     - This script contains a simple class that initializes a UDP socket and has some methods within that
-    are very useful for the client and the server. 
+    are very useful for the client and the server. Once started on an asyncio event loop the socket
+    is read by a datagram protocol and requests can await the response carrying their request id.
+    Messages go out in the socket's wire format (see wire.py) and both formats are read. A reliable
+    socket sends everything through a ReliableChannel (see reliable.py), every socket can receive from one.
+    Given a Metrics (see metrics.py) the socket counts the bytes, datagrams and message types going each way.
 
 '''
 
 
-import json
+from itertools import count
+from reliable import ReliableChannel, is_reliable
+import asyncio
 import socket
 import sys
+import wire
+
+
+# Waiter type of a command sent to the server, it is answered with its success type, its error type or a plain error
+ANY_TYPE = '*'
 
 
 class UDPServer:
-    def __init__(self):
+    def __init__(self, wire_format='json', reliable=False, metrics=None, name='udp'):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.wire_format = wire_format
+        self.reliable = reliable
+        # Counters are labelled with the socket name so a node's four sockets can be told apart
+        self.metrics = metrics
+        self.name = name
+        self.channel = ReliableChannel(self)
+        self.transport = None
+        self.handler = None
+        # Request id -> (message type, future waiting on the response with that id and type)
+        self.waiters = {}
+        self.request_ids = count(1)
+
+    class Protocol(asyncio.DatagramProtocol):
+        '''Hands every datagram read by the event loop back to the UDPServer'''
+        def __init__(self, server):
+            self.server = server
+
+        def datagram_received(self, data, addr):
+            self.server.datagram_received(data, addr)
 
+        def error_received(self, exc):
+            print(f"udp-server: {exc}")
+
+    @staticmethod
     def die_with_error(error_message):
         '''Function to kill the program and ouput the error message'''
         sys.exit(error_message)
 
+    async def start(self, handler, addr=None):
+        '''
+            Bind the socket if given an address and start reading it on the running event loop
+            Every datagram that isn't a response to a request is passed to handler(data, addr)
+        '''
+        if addr:
+            self.socket.bind(addr)
+        self.socket.setblocking(False)
+        self.handler = handler
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self.Protocol(self), sock=self.socket)
+
+    def datagram_received(self, data, addr):
+        '''Unwrap reliable frames, then hand off everything that is ready in order'''
+        if self.metrics:
+            self.metrics.inc('datagrams_received_total', socket=self.name)
+            self.metrics.inc('bytes_received_total', len(data), socket=self.name)
+        if is_reliable(data):
+            for payload in self.channel.datagram_received(data, addr):
+                self.deliver(payload, addr)
+        else:
+            self.deliver(data, addr)
+
+    def deliver(self, data, addr):
+        '''Resolve the request waiting on this response, otherwise pass it along to the handler'''
+        if self.waiters:
+            try:
+                data_loaded = wire.decode(data)
+            except:
+                data_loaded = None
+            # The type has to match too so a stray message that happens to carry the request id isn't taken as the response
+            waiter = self.waiters.get(data_loaded.get('rid')) if isinstance(data_loaded, dict) else None
+            if waiter and waiter[0] in (ANY_TYPE, data_loaded.get('type')):
+                future = self.waiters.pop(data_loaded['rid'])[1]
+                self.count_message('received', data_loaded['type'])
+                if not future.done():
+                    future.set_result(data_loaded)
+                return
 
-    def send_response(self, addr, res, type, data=None):
-        '''Function to send response from server to client to avoid repetition'''
-        response_data = json.dumps({
+        if self.handler:
+            self.handler(data, addr)
+
+    def send_message(self, message, addr):
+        '''Send a message dict in the socket's wire format'''
+        self.count_message('sent', wire.message_name(message))
+        return self.sendto(wire.encode(message, self.wire_format), addr)
+
+    def sendto(self, data, addr):
+        '''
+            Send bytes, through the reliable channel if this socket is reliable and has been started
+            Returns a future that is done once the datagram is acked when sent reliably
+        '''
+        if self.reliable and self.transport:
+            return self.channel.send(data, addr)
+        self.send_raw(data, addr)
+
+    def send_raw(self, data, addr):
+        '''Send raw bytes, through the event loop once the server has been started'''
+        if self.metrics:
+            self.metrics.inc('datagrams_sent_total', socket=self.name)
+            self.metrics.inc('bytes_sent_total', len(data), socket=self.name)
+        if self.transport:
+            self.transport.sendto(data, addr)
+        else:
+            self.socket.sendto(data, addr)
+
+    def send_response(self, addr, res, type, data=None, rid=None, format=None):
+        '''Function to send response from server to client to avoid repetition, in the socket's wire format unless given one'''
+        response = {
                 'res': res,
                 'type': type,
                 'data': data
-            })
+            }
+        if rid is not None:
+            # Request id of the message this is answering so the receiver can match them up
+            response['rid'] = rid
+        self.count_message('sent', type)
+        return self.sendto(wire.encode(response, format or self.wire_format), addr)
+
+    def count_message(self, direction, type):
+        '''Count a message sent or received by its type, responses to requests are counted here and the rest by the handler'''
+        if self.metrics:
+            self.metrics.inc(f'messages_{direction}_total', type=type, socket=self.name)
+
+    async def request(self, addr, res, type, data=None, timeout=2.0, response_type=None):
+        '''
+            Send a message with a new request id and wait for the response carrying the same id and type,
+            or response_type when the answer has a type of its own
+            Raises asyncio.TimeoutError if nothing comes back in time
+        '''
+        rid = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[rid] = (response_type or type, future)
+        self.send_response(addr, res, type, data, rid=rid)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.waiters.pop(rid, None)
+
+    async def command(self, addr, command, timeout=2.0):
+        '''
+            Send a command string to the server with a new request id and wait for the response carrying the same id
+            Raises asyncio.TimeoutError if nothing comes back in time
+        '''
+        rid = next(self.request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[rid] = (ANY_TYPE, future)
+        self.count_message('sent', command.split()[0] if command.split() else 'none')
+        self.sendto(wire.encode_command(command, self.wire_format, rid), addr)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.waiters.pop(rid, None)
 
-        self.socket.sendto(bytes(response_data, 'utf-8'), addr)
\ No newline at end of file
+    async def drain(self):
+        '''
+            Wait until every reliable datagram sent so far has been acked or given up on
+            Returns how many were given up on
+        '''
+        results = await asyncio.gather(*self.channel.pending(), return_exceptions=True)
+        return sum(1 for result in results if isinstance(result, BaseException))
@@ -20,104 +20,157 @@ Usage:
 
 
 from Server import UDPServer
+from metrics import Metrics
 from state import StateInfo
+import asyncio
 import sys
+import time
+import wire
 
 
-BUFFER_SIZE = 1024
-    
+VIRTUAL_NODES = 0 # Virtual nodes per DHT member for consistent hashing, 0 keeps the pos % n partitioning
+LOG_COMMANDS = False # Print every command received, slows the server down a lot under load
+METRICS_ENDPOINT = None # Local TCP port or Unix socket path to serve the metrics to Prometheus on, None turns it off
+
+# Counters and histograms of the server, answered with the stats command
+METRICS = Metrics(node='server')
+
+
+def setup_dht(state, data_list):
+    '''setup-dht ⟨n⟩ ⟨user-name⟩'''
+    if state.dht_flag:
+        return None, 'DHT already created'
+
+    return state.setup_dht(data_list)
+
+
+def dht_complete(state, data_list):
+    '''dht-complete ⟨user-name⟩'''
+    if len(data_list) != 2:
+        return None, "Invalid number of arguments - expected 2."
+
+    if data_list[1] != state.dht_leader:
+        return None, f"{state.dht_leader} is the DHT leader, not {data_list[1]}"
+
+    if not state.creating_dht:
+        return None, "DHT is not currently being created"
+
+    state.creating_dht = False
+    return None, None
+
+
+def display_users(state, data_list):
+    state.display_users()
+    return None, None
+
+
+def display_dht(state, data_list):
+    state.display_dht()
+    return None, None
+
+
+def stats(state, data_list):
+    '''stats'''
+    return METRICS.snapshot(), None
+
+
+# Command -> (handler, success type, failure type), every handler takes (state, data_list) and returns (res, err)
+COMMANDS = {
+    'register': (StateInfo.register, 'register', 'register-error'),
+    'setup-dht': (setup_dht, 'DHT', 'DHT-error'),
+    'deregister': (StateInfo.deregister, 'deregister', 'deregister-error'),
+    'query-dht': (StateInfo.valid_query, 'query-response', 'query-error'),
+    # A find uses the same checks as a query since it also needs a random DHT maintainer to start at
+    'find-dht': (StateInfo.valid_query, 'find-response', 'find-error'),
+    'get-view': (StateInfo.get_view, 'view-response', 'view-error'),
+    # Only maintainers are given the view for their snapshots, free users go through get-view
+    'restore-view': (StateInfo.restore_view, 'restore-view-response', 'restore-view-error'),
+    'dht-complete': (dht_complete, 'dht-setup', 'dht-setup-error'),
+    'join-dht': (StateInfo.join_dht, 'join-response', 'join-error'),
+    'leave-dht': (StateInfo.leave_dht, 'leave-response', 'leave-error'),
+    'dht-rebuilt': (StateInfo.dht_rebuilt, 'rebuilt-response', 'rebuilt-error'),
+    'teardown-dht': (StateInfo.teardown_dht, 'teardown-response', 'teardown-error'),
+    'teardown-complete': (StateInfo.teardown_complete, 'teardown-complete', 'teardown-complete-error'),
+    'node-failed': (StateInfo.node_failed, 'failed-response', 'failed-error'),
+    'display-users': (display_users, 'debugging', 'error'),
+    'display-dht': (display_dht, 'debugging', 'error'),
+    'stats': (stats, 'stats', 'stats-error')
+}
+
 
 def parse_data(server, state, data, address):
     '''
-        This function will parse any messages sent to the server and call the corresponding functions
+        This function will parse any messages sent to the server and call the corresponding handler
         If the command doesn't match any that the parser knows, responds with error
     '''
-    if data:
-        print(f"server: received string ``{data.decode('utf-8')}'' from client on ip: {address[0]} port {address[1]}\n")
-        data_list = data.decode('utf-8').split()
-        command = data_list[0]
-        if state.creating_dht and command != 'dht-complete':
-            server.send_response(addr=address, res='FAILURE', type='error', data='Creating DHT')
-        elif state.stabilizing_dht and command != 'dht-rebuilt':
-            server.send_response(addr=address, res='FAILURE', type='error', data='Stabilizing DHT')
-        elif command == 'register':
-            res, err = state.register(data_list)
-            if err:
-                server.send_response(addr=address, res='FAILURE', type='register-error', data=err)
-            else:
-                server.send_response(addr=address, res='SUCCESS', type='register', data=res)
-        elif command == 'setup-dht':
-            # setup-dht ⟨n⟩ ⟨user-name⟩
-            if state.dht_flag:
-                server.send_response(addr=address, res='FAILURE', type='setup-dht', data='DHT already created')
-            else:
-                # Make call to setup_dht
-                res, err = state.setup_dht(data_list)
-                if err:
-                    server.send_response(addr=address, res='FAILURE', type='DHT-error', data=err)
-                else:
-                    server.send_response(addr=address, res='SUCCESS', type='DHT', data=res)
-        elif command == 'deregister':
-            res, err = state.deregister(data_list)
-            if err:
-                server.send_response(addr=address, res='FAILURE', type='deregister-error', data=err)
-            else:
-                server.send_response(addr=address, res='SUCCESS', type='deregister', data=res)
-        elif command == 'query-dht':
-            res, err = state.valid_query(data_list)
-            if err:
-                server.send_response(addr=address, res='FAILURE', type='query-error', data=err)
-            else:
-                server.send_response(addr=address, res='SUCCESS', type='query-response', data=res)
-        elif command == 'dht-complete':
-            if data_list[1] == state.dht_leader:
-                if state.creating_dht:
-                    state.creating_dht = False
-                    server.send_response(addr=address, res='SUCCESS', type='dht-setup')
-                else:
-                    server.send_response(addr=address, res='FAILURE', type='dht-setup-error', data="DHT is not currently being created")
-            else:
-                server.send_response(addr=address, res='FAILURE', type='dht-setup-error', data=f"{state.dht_leader} is the DHT leader, not {data_list[1]}")
-        elif command == 'join-dht':
-            res, err = state.join_dht(data_list)
-            if err:
-                server.send_response(addr=address, res='FAILURE', type='join-error', data=err)
-            else:
-                server.send_response(addr=address, res='SUCCESS', type='join-response', data=res)
-        elif command == 'leave-dht':
-            res, err = state.leave_dht(data_list)
-            if err:
-                server.send_response(addr=address, res='FAILURE', type='leave-error', data=err)
-            else:
-                server.send_response(addr=address, res='SUCCESS', type='leave-response', data=res)
-        elif command == 'dht-rebuilt':
-            res, err = state.dht_rebuilt(data_list)
-            if err:
-                server.send_response(addr=address, res='FAILURE', type='rebuilt-error', data=err)
-            else:
-                server.send_response(addr=address, res='SUCCESS', type='rebuilt-response', data=res)
-        elif command == 'teardown-dht':
-            res, err = state.teardown_dht(data_list)
-            if err:
-                server.send_response(addr=address, res='FAILURE', type='teardown-error', data=err)
-            else:
-                server.send_response(addr=address, res='SUCCESS', type='teardown-response', data=res)
-        elif command == 'teardown-complete':
-            res, err = state.teardown_complete(data_list)
-            if err:
-                server.send_response(addr=address, res='FAILURE', type='teardown-complete-error', data=err)
-            else:
-                server.send_response(addr=address, res='SUCCESS', type='teardown-complete', data=res)
-        elif command == 'display-users':
-            state.display_users()
-            server.send_response(addr=address, res='SUCCESS', type='debugging')
-        elif command == 'display-dht':
-            state.display_dht()
-            server.send_response(addr=address, res='SUCCESS', type='debugging')
-        else:
-            server.send_response(addr=address, res='FAILURE', type='error', data='Unkown command')
-    
-    return server, state
+    if not data:
+        return
+
+    # Answer in whichever format the client used, echoing the request id so the client can match the response up
+    format = wire.format_of(data)
+    try:
+        data_list, rid = wire.decode_command(data)
+    except (ValueError, KeyError, TypeError, UnicodeDecodeError) as error:
+        server.send_response(addr=address, res='FAILURE', type='error', data=f'Unreadable command: {error}', format=format)
+        return
+
+    if LOG_COMMANDS:
+        print(f"server: received string ``{' '.join(data_list)}'' from client on ip: {address[0]} port {address[1]}\n")
+
+    server.count_message('received', data_list[0] if data_list else 'none')
+    if not data_list or data_list[0] not in COMMANDS:
+        server.send_response(addr=address, res='FAILURE', type='error', data='Unkown command', rid=rid, format=format)
+        return
+
+    command = data_list[0]
+    # While the DHT is being created or rebuilt only the completing command gets through
+    if state.creating_dht and command != 'dht-complete':
+        server.send_response(addr=address, res='FAILURE', type='error', data='Creating DHT', rid=rid, format=format)
+        return
+    if state.stabilizing_dht and command != 'dht-rebuilt':
+        server.send_response(addr=address, res='FAILURE', type='error', data='Stabilizing DHT', rid=rid, format=format)
+        return
+
+    handler, success_type, error_type = COMMANDS[command]
+    start_time = time.perf_counter()
+    try:
+        res, err = handler(state, data_list)
+    except (IndexError, KeyError, ValueError) as error:
+        res, err = None, f"Invalid {command} command: {error}"
+    METRICS.observe('command_ms', (time.perf_counter() - start_time) * 1000, command=command)
+
+    if err:
+        METRICS.inc('command_errors_total', command=command)
+        server.send_response(addr=address, res='FAILURE', type=error_type, data=err, rid=rid, format=format)
+    else:
+        server.send_response(addr=address, res='SUCCESS', type=success_type, data=res, rid=rid, format=format)
+
+
+async def serve(server_port):
+    '''Start the server socket on the event loop and dispatch commands until the process is killed'''
+    server = UDPServer(metrics=METRICS, name='server')
+    state = StateInfo(server_port, VIRTUAL_NODES)
+    METRICS.gauge('registered_users', lambda: len(state.state_table))
+    for user_state in ('Free', 'Leader', 'InDHT'):
+        METRICS.gauge('users', lambda user_state=user_state: len(state.by_state[user_state]), state=user_state)
+    METRICS.gauge('members', lambda: len(state.dht))
+    METRICS.gauge('epoch', lambda: state.epoch)
+
+    try:
+        await server.start(lambda data, addr: parse_data(server, state, data, addr), ("", server_port))
+    except OSError:
+        server.die_with_error("server: bind() failed")
+
+    print(f"server: Port server is listening to is: {server_port}\n")
+
+    if METRICS_ENDPOINT:
+        try:
+            await METRICS.serve(METRICS_ENDPOINT)
+            print(f"server: serving /metrics on {METRICS_ENDPOINT}\n")
+        except OSError as error:
+            print(f"server: could not serve the metrics on {METRICS_ENDPOINT}, {error}\n")
+
+    await asyncio.Event().wait()
 
 
 def main(args):
@@ -127,27 +180,14 @@ def main(args):
     '''
     if len(args) != 2:
         sys.exit(f"Usage:  {args[0]} <UDP SERVER PORT>\n")
-    
 
     server_port = int(args[1])  # First arg: Use given port
 
-    server = UDPServer()
-    state = StateInfo(server_port)
-
     try:
-        server.socket.bind(("", server_port))
-    except:
-        server.die_with_error("server: bind() failed")
-        
-    print(f"server: Port server is listening to is: {server_port}\n")
-    
-    # Add loop here so that we can disconnect and reconnect to server
-    while True:
-        message, addr = server.socket.recvfrom(BUFFER_SIZE)
-        # print(f"server connected by addr: {addr}")
-
-        server, state = parse_data(server, state, message, addr)
+        asyncio.run(serve(server_port))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
-    main(sys.argv)
\ No newline at end of file
+    main(sys.argv)
@@ -0,0 +1,72 @@
+'''
+Developer: Austin Spencer
+Class: CSE 434 Computer Networks
+Professor: Syrotiuk
+Due: 10/17/2021
+Group: 85
+Ports: 4300 - 43499
+
+About:  Purpose of this project is to implement your own application program in which processes
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
+    answer queries using it.
+
+batcher.py:
+    - This script contains the RecordBatcher class which packs records headed to the same
+    address into a single 'records' (or 'handoff') datagram instead of sending one datagram per record
+
+'''
+
+
+import json
+
+
+class RecordBatcher:
+    '''Buffers records per destination address and message type and sends them as batched messages'''
+    def __init__(self, server, max_bytes, batch_size):
+        self.server = server
+        self.max_bytes = max_bytes
+        self.batch_size = batch_size
+        self.pending = {}
+        self.records_sent = 0
+        self.datagrams_sent = 0
+
+    def envelope_size(self, type):
+        '''Bytes taken up by the message without any records in it'''
+        return len(json.dumps({'res': 'SUCCESS', 'type': type, 'data': []}))
+
+    def add(self, addr, record, type='records'):
+        '''Add a record to the batch for the given address, sending the batch first if the record won't fit'''
+        key = (tuple(addr), type)
+        # Each record also takes up a comma and a space within the list
+        record_size = len(json.dumps(record)) + 2
+        records, size = self.pending.get(key, ([], self.envelope_size(type)))
+
+        if records and (len(records) >= self.batch_size or size + record_size > self.max_bytes):
+            self.flush(key)
+            records, size = [], self.envelope_size(type)
+
+        records.append(record)
+        self.pending[key] = (records, size + record_size)
+
+    def flush(self, key):
+        '''Send whatever records are waiting on the given (address, type) pair'''
+        records, _ = self.pending.pop(key, ([], 0))
+        if not records:
+            return
+
+        addr, type = key
+        try:
+            self.server.send_response(addr=addr, res='SUCCESS', type=type, data=records)
+            self.records_sent += len(records)
+            self.datagrams_sent += 1
+        except:
+            print("client-node: sendall() error within records batch")
+
+    def flush_all(self):
+        '''Send every batch that is still waiting'''
+        for key in list(self.pending.keys()):
+            self.flush(key)
+
+    def reset_counters(self):
+        self.records_sent = 0
+        self.datagrams_sent = 0
@@ -0,0 +1,86 @@
+'''
+Developer: Austin Spencer
+Class: CSE 434 Computer Networks
+Professor: Syrotiuk
+Due: 10/17/2021
+Group: 85
+Ports: 4300 - 43499
+
+About:  Purpose of this project is to implement your own application program in which processes
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
+    answer queries using it.
+
+cache.py:
+    - This script contains the QueryCache class, a bounded LRU of query results kept by the node a
+    query enters the DHT at. Results are tagged with the DHT epoch handed out by the server, as soon as
+    a query shows up carrying a newer epoch everything cached under the old one is thrown away
+
+'''
+
+
+from collections import OrderedDict
+
+
+class QueryCache:
+    '''LRU cache of key -> record (None for a record that wasn't found) for a single DHT epoch'''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.epoch = None
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        '''Check for a result without counting a hit or a miss'''
+        return key in self.entries
+
+    def current(self, epoch):
+        '''
+            Check the epoch against the one the cache holds, a newer epoch empties the cache
+            Returns True if results from this epoch can be served and stored
+        '''
+        if epoch is None:
+            return False
+        if self.epoch is None or epoch > self.epoch:
+            self.invalidate()
+            self.epoch = epoch
+
+        return epoch == self.epoch
+
+    def get(self, key, epoch):
+        '''Returns (True, record) on a hit and (False, None) on a miss'''
+        if self.current(epoch) and key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, self.entries[key]
+
+        self.misses += 1
+        return False, None
+
+    def put(self, key, record, epoch):
+        '''Cache the result of a query, results from an older epoch are dropped'''
+        if not self.capacity or not self.current(epoch):
+            return
+
+        self.entries[key] = record
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self):
+        '''Drop every cached result, the epoch stays so older results still can't get back in'''
+        if self.entries:
+            self.invalidations += 1
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0
+        return (f"{self.hits} hits, {self.misses} misses ({hit_rate:.0f}% hit rate), {self.evictions} evictions, "
+                f"{len(self.entries)}/{self.capacity} entries at epoch {self.epoch}")
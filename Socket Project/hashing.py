@@ -0,0 +1,63 @@
+'''
+Developer: Austin Spencer
+Class: CSE 434 Computer Networks
+Professor: Syrotiuk
+Due: 10/17/2021
+Group: 85
+Ports: 4300 - 43499
+
+About:  Purpose of this project is to implement your own application program in which processes
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
+    answer queries using it.
+
+hashing.py:
+    - This script holds the key hash functions a node can pick from. Every function takes the key
+    string and returns a non-negative int that is used for both the bucket and the owner of a record
+
+'''
+
+
+import hashlib
+
+
+FNV_OFFSET_BASIS = 0xcbf29ce484222325
+FNV_PRIME = 0x100000001b3
+MASK_64 = 0xffffffffffffffff
+
+
+def ascii_sum(key):
+    '''The original hash, sums up the ascii codes of the key'''
+    ascii_sum = 0
+    for letter in key:
+        ascii_sum += ord(letter)
+
+    return ascii_sum
+
+
+def fnv1a_64(key):
+    '''64 bit FNV-1a hash of the utf-8 bytes of the key'''
+    hash_value = FNV_OFFSET_BASIS
+    for byte in key.encode('utf-8'):
+        hash_value = ((hash_value ^ byte) * FNV_PRIME) & MASK_64
+
+    return hash_value
+
+
+def blake2b_64(key):
+    '''64 bit blake2b digest of the key, runs in C so it is the fastest well mixed choice'''
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+HASH_FUNCTIONS = {
+    'ascii': ascii_sum,
+    'fnv1a': fnv1a_64,
+    'blake2b': blake2b_64
+}
+
+
+def get_hash_function(name):
+    '''Look up a hash function by name'''
+    if name not in HASH_FUNCTIONS:
+        raise ValueError(f"Unknown hash function {name}, expected one of {', '.join(HASH_FUNCTIONS)}")
+
+    return HASH_FUNCTIONS[name]
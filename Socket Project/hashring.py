@@ -0,0 +1,72 @@
+'''
+Developer: Austin Spencer
+Class: CSE 434 Computer Networks
+Professor: Syrotiuk
+Due: 10/17/2021
+Group: 85
+Ports: 4300 - 43499
+
+About:  Purpose of this project is to implement your own application program in which processes
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
+    answer queries using it.
+
+hashring.py:
+    - This script contains the HashRing class used for consistent hashing. Every node is placed
+    on the ring at several virtual points so a join or leave only moves the keys of its own arcs
+
+'''
+
+
+from bisect import bisect_right
+from hashing import blake2b_64
+
+
+RING_MASK = 0xffffffff # The ring is 32 bits around
+
+
+class HashRing:
+    '''Consistent hash ring built from the DHT membership list'''
+    def __init__(self, dht, vnodes, hash_function=blake2b_64):
+        self.vnodes = vnodes
+        self.hash_function = hash_function
+        self.points = []
+        self.owners = []
+
+        # Usernames are used for the points since the ids change whenever a node leaves
+        ring = sorted(
+            (self.hash_function(f"{node['username']}#{i}") & RING_MASK, index)
+            for index, node in enumerate(dht) for i in range(vnodes)
+        )
+        for point, index in ring:
+            self.points.append(point)
+            self.owners.append(dht[index])
+
+    def owner(self, key_hash):
+        '''Return the node owning the key with the given hash, the first point clockwise from the key'''
+        index = bisect_right(self.points, key_hash & RING_MASK)
+        if index == len(self.points):
+            index = 0
+
+        return self.owners[index]
+
+    def replicas(self, key_hash, count):
+        '''Return the owner of the key followed by the next distinct nodes clockwise, count of them at most'''
+        start = bisect_right(self.points, key_hash & RING_MASK)
+        nodes = {}
+        for i in range(len(self.points)):
+            node = self.owners[(start + i) % len(self.points)]
+            nodes.setdefault(node['username'], node)
+            if len(nodes) == count:
+                break
+
+        return list(nodes.values())
+
+    def arc_holders(self, username):
+        '''Return the nodes currently holding the arcs that a node with the given username takes over on joining'''
+        holders = {}
+        for i in range(self.vnodes):
+            # The owner of a new point is the node that held the whole arc ending at it
+            node = self.owner(self.hash_function(f"{username}#{i}"))
+            holders[node['username']] = node
+
+        return list(holders.values())
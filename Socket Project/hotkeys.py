@@ -0,0 +1,115 @@
+'''
+Developer: Austin Spencer
+Class: CSE 434 Computer Networks
+Professor: Syrotiuk
+Due: 10/17/2021
+Group: 85
+Ports: 4300 - 43499
+
+About:  Purpose of this project is to implement your own application program in which processes
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
+    answer queries using it.
+
+hotkeys.py:
+    - This script contains the HotKeys class, a count-min sketch of how often each key is asked for.
+    The sketch is a fixed block of counters no matter how many keys there are, and every counter is
+    halved at the end of a window so old traffic fades out. Keys whose count crosses the threshold are
+    reported as hot so their owner can spread them over more nodes, and reported again once they cool
+    below half of it
+
+'''
+
+
+from array import array
+import hashlib
+
+
+SKETCH_WIDTH = 1024 # Counters in each row of the sketch
+SKETCH_DEPTH = 4 # Rows of counters, a key's count is the smallest of its counter in each row
+TOP_KEYS = 16 # Most requested keys kept by name for the stats
+
+
+class HotKeys:
+    '''Count-min sketch of the requests for each key that reports the keys crossing the threshold either way'''
+    def __init__(self, threshold, width=SKETCH_WIDTH, depth=SKETCH_DEPTH, top=TOP_KEYS):
+        self.threshold = threshold
+        self.width = width
+        self.depth = depth
+        self.top = top
+        self.counters = array('L', [0]) * (width * depth)
+        # key -> count of the most requested keys so the stats can name them
+        self.top_keys = {}
+        self.hot = set()
+        self.requests = 0
+        self.promotions = 0
+        self.demotions = 0
+        self.windows = 0
+
+    def positions(self, key):
+        '''The key's counter in every row, picked with two halves of a single digest'''
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'big')
+        second = int.from_bytes(digest[8:], 'big') | 1
+        return [row * self.width + (first + row * second) % self.width for row in range(self.depth)]
+
+    def estimate(self, key):
+        '''Count of the requests for the key, never less than the real count and only more on collisions'''
+        return min(self.counters[i] for i in self.positions(key))
+
+    def record(self, key, weight=1):
+        '''
+            Count a request for the key, weight is how many requests it stands for when the reads are
+            spread over several nodes and only one of them counts
+            Returns True when the key has just become hot
+        '''
+        self.requests += 1
+        positions = self.positions(key)
+        for i in positions:
+            self.counters[i] += weight
+        estimate = min(self.counters[i] for i in positions)
+        self.track(key, estimate)
+
+        if estimate >= self.threshold and key not in self.hot:
+            self.hot.add(key)
+            self.promotions += 1
+            return True
+        return False
+
+    def track(self, key, estimate):
+        '''Keep the key by name if it is one of the most requested'''
+        if key in self.top_keys or len(self.top_keys) < self.top:
+            self.top_keys[key] = estimate
+            return
+
+        coldest = min(self.top_keys, key=self.top_keys.get)
+        if estimate > self.top_keys[coldest]:
+            del self.top_keys[coldest]
+            self.top_keys[key] = estimate
+
+    def decay(self):
+        '''
+            End the window by halving every counter so a key has to keep being asked for to stay hot
+            Returns the hot keys that fell below half the threshold during the window
+        '''
+        self.windows += 1
+        cooled = [key for key in self.hot if self.estimate(key) < self.threshold / 2]
+        for key in cooled:
+            self.hot.discard(key)
+        self.demotions += len(cooled)
+
+        self.counters = array('L', (count >> 1 for count in self.counters))
+        self.top_keys = {key: count >> 1 for key, count in self.top_keys.items() if count > 1}
+
+        return cooled
+
+    def reset(self):
+        '''Forget which keys are hot so they are reported again, the counts are kept'''
+        self.hot.clear()
+
+    def hottest(self, count=5):
+        '''The most requested keys and their counts, most requested first'''
+        return sorted(self.top_keys.items(), key=lambda item: item[1], reverse=True)[:count]
+
+    def stats(self):
+        return (f"{self.requests} requests counted, {len(self.hot)} hot keys, {self.promotions} promotions, "
+                f"{self.demotions} demotions, threshold {self.threshold} over {self.windows} windows")
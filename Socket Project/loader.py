@@ -0,0 +1,133 @@
+'''
+Developer: Austin Spencer
+Class: CSE 434 Computer Networks
+Professor: Syrotiuk
+Due: 10/17/2021
+Group: 85
+Ports: 4300 - 43499
+
+About:  Purpose of this project is to implement your own application program in which processes
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
+    answer queries using it.
+
+loader.py:
+    - This script contains the RecordLoader class which streams the records of a csv file in chunks of
+    rows. The file is memory mapped when it can be and read a block at a time when it can't, so only a
+    block and one chunk of rows are held at once no matter how big the file is. Rows can be cut down to
+    a projection of their columns, the key column is always kept
+
+'''
+
+
+from itertools import chain
+import csv
+import io
+import mmap
+import time
+
+
+BLOCK_BYTES = 1 << 18 # Bytes of the file decoded at a time
+CHUNK_ROWS = 1024 # Rows handed back at a time
+
+
+class RecordLoader:
+    '''Reads a csv file as chunks of record dicts and keeps count of how fast it went'''
+    def __init__(self, path, key_column='Long Name', columns=None, chunk_rows=CHUNK_ROWS, block_bytes=BLOCK_BYTES):
+        self.path = path
+        self.key_column = key_column
+        self.columns = columns
+        self.chunk_rows = chunk_rows
+        self.block_bytes = block_bytes
+        self.rows = 0
+        self.skipped = 0
+        self.bytes_read = 0
+        self.elapsed = 0
+        self.mapped = False
+
+    def blocks(self, data_file):
+        '''Blocks of raw bytes from the file, straight out of a memory map unless the file can't be mapped'''
+        try:
+            mapped = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files, pipes and the like can't be mapped
+            mapped = None
+
+        self.mapped = mapped is not None
+        if mapped is None:
+            for block in iter(lambda: data_file.read(self.block_bytes), b''):
+                yield block
+            return
+
+        with mapped:
+            for offset in range(0, len(mapped), self.block_bytes):
+                yield mapped[offset:offset + self.block_bytes]
+
+    def lines(self, data_file):
+        '''
+            Decoded lines of the file a block at a time, only ever holding one block and the line cut off at its end
+            Each block is a StringIO so the lines are split in C, and only at real line breaks unlike splitlines()
+        '''
+        tail = b''
+        for block in self.blocks(data_file):
+            self.bytes_read += len(block)
+            block = tail + block
+            end = block.rfind(b'\n') + 1
+            tail = block[end:]
+            if end:
+                yield io.StringIO(block[:end].decode('utf-8'), newline='')
+        if tail:
+            yield io.StringIO(tail.decode('utf-8'), newline='')
+
+    def projection(self, header):
+        '''Positions and names of the columns to keep, raises ValueError if the file is missing any of them'''
+        columns = list(header) if self.columns is None else list(self.columns)
+        if self.key_column not in columns:
+            columns.insert(0, self.key_column)
+
+        missing = [column for column in columns if column not in header]
+        if missing:
+            raise ValueError(f"{self.path} has no column {', '.join(missing)}")
+
+        return [header.index(column) for column in columns], columns
+
+    def chunks(self):
+        '''
+            Yield lists of up to chunk_rows records with only the projected columns
+            Rows that are too short to have every projected column are skipped
+        '''
+        self.rows = self.skipped = self.bytes_read = 0
+        start_time = time.perf_counter()
+        with open(self.path, 'rb') as data_file:
+            # csv handles quoted fields running over more than one line itself
+            reader = csv.reader(chain.from_iterable(self.lines(data_file)))
+            header = next(reader, None)
+            if header is None:
+                return
+            # Files saved by Excel start with a byte order mark
+            header[0] = header[0].lstrip('\ufeff')
+            positions, columns = self.projection(header)
+            last = max(positions)
+            # Keeping every column in order needs no picking out
+            every_column = columns == header
+
+            chunk = []
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) <= last:
+                    self.skipped += 1
+                    continue
+                chunk.append(dict(zip(columns, row if every_column else [row[i] for i in positions])))
+                if len(chunk) == self.chunk_rows:
+                    self.rows += len(chunk)
+                    self.elapsed = time.perf_counter() - start_time
+                    yield chunk
+                    chunk = []
+
+            self.rows += len(chunk)
+            if chunk:
+                yield chunk
+        self.elapsed = time.perf_counter() - start_time
+
+    def rate(self):
+        return self.rows / self.elapsed if self.elapsed else 0
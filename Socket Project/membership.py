@@ -0,0 +1,112 @@
+'''
+Developer: Austin Spencer
+Class: CSE 434 Computer Networks
+Professor: Syrotiuk
+Due: 10/17/2021
+Group: 85
+Ports: 4300 - 43499
+
+About:  Purpose of this project is to implement your own application program in which processes
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
+    answer queries using it.
+
+membership.py:
+    - This script holds the helper functions that build and update the DHT membership list
+    (the 'dht' list of node dictionaries ordered by id) and the finger tables built from it
+
+'''
+
+
+def renumber(dht):
+    '''Reset the id and n values of every node in the membership list to match its position'''
+    n = len(dht)
+    for index, node in enumerate(dht):
+        node['id'] = index
+        node['n'] = n
+
+    return dht
+
+
+def leave_membership(dht, username):
+    '''
+        Build the membership list once the given user leaves the DHT
+        The node right after the leaving user becomes the new leader with id 0
+    '''
+    index = next(i for i, node in enumerate(dht) if node['username'] == username)
+    new_dht = [dict(node) for node in dht[index+1:] + dht[:index]]
+
+    return renumber(new_dht)
+
+
+def join_membership(dht, new_node):
+    '''Build the membership list once the given node joins the DHT, the new node is given the last id'''
+    new_dht = [dict(node) for node in dht]
+    new_dht.append(dict(new_node))
+
+    return renumber(new_dht)
+
+
+def remove_membership(dht, username):
+    '''
+        Build the membership list once the given user has failed and been spliced out
+        Everyone else keeps their order so the leader stays first unless it is the one that failed
+    '''
+    new_dht = [dict(node) for node in dht if node['username'] != username]
+
+    return renumber(new_dht)
+
+
+def replica_set(dht, ring, key_hash, count):
+    '''
+        The nodes that hold the key, the owner first and then its successors, count of them at most
+        Successors are the next ids around the DHT, or the next nodes clockwise on the hash ring if there is one
+    '''
+    if ring:
+        return ring.replicas(key_hash, count)
+
+    owner = key_hash % len(dht)
+    return [dht[(owner + i) % len(dht)] for i in range(min(count, len(dht)))]
+
+
+def same_membership(dht, other_dht):
+    '''Check if the two membership lists hold the same nodes at the same addresses in the same order'''
+    addresses = lambda dht: [(node['username'], node['ip'], int(node['port']), int(node['query'])) for node in dht or []]
+    return dht is not None and other_dht is not None and addresses(dht) == addresses(other_dht)
+
+
+def build_finger_table(dht, node_id):
+    '''
+        Build the Chord style finger table for the node with the given id
+        Entry k points at the node with id (node_id + 2^k) % n
+    '''
+    n = len(dht)
+    finger_table = []
+    step = 1
+    while step < n:
+        finger_table.append(dht[(node_id + step) % n])
+        step *= 2
+
+    return finger_table
+
+
+def successor_list(dht, node_id, count):
+    '''The next count nodes after the node with the given id, never wrapping back around to the node itself'''
+    n = len(dht)
+    return [dht[(node_id + i) % n] for i in range(1, min(count, n - 1) + 1)]
+
+
+def closest_finger(finger_table, node_id, target_id, n):
+    '''
+        Return the finger that gets closest to the target id without passing it
+        Since ids are dense this is the finger with the largest 2^k that is <= the distance to the target
+    '''
+    distance = (target_id - node_id) % n
+    closest = None
+    step = 1
+    for finger in finger_table:
+        if step > distance:
+            break
+        closest = finger
+        step *= 2
+
+    return closest
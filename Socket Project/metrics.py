@@ -0,0 +1,189 @@
+'''
+Developer: Austin Spencer
+Class: CSE 434 Computer Networks
+Professor: Syrotiuk
+Due: 10/17/2021
+Group: 85
+Ports: 4300 - 43499
+
+About:  Purpose of this project is to implement your own application program in which processes
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
+    answer queries using it.
+
+metrics.py:
+    - This script contains the Metrics class kept by the server and every node. It holds counters,
+    gauges read off the live state when asked for, and histograms with fixed buckets. They can be
+    printed for the stats command or served over a local TCP port or Unix socket in the Prometheus
+    text format so they can be scraped while the DHT is under load
+
+'''
+
+
+from bisect import bisect_left
+import asyncio
+import os
+import time
+
+
+PREFIX = 'dht_'
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000) # Milliseconds
+HOP_BUCKETS = (0, 1, 2, 3, 4, 5, 6, 8, 10, 12, 16)
+
+
+def format_labels(labels):
+    '''Labels as {name="value",...}, nothing at all when there are none'''
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+class Histogram:
+    '''Counts of the observations falling in each bucket, the last bucket takes everything over the top bound'''
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, fraction):
+        '''Upper bound of the bucket the given fraction of the observations fall under'''
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+
+        return 0
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': round(self.sum / self.count, 3) if self.count else 0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99)
+        }
+
+
+class Metrics:
+    '''Counters, gauges and histograms of one process, every sample carries the labels it was made with'''
+    def __init__(self, **labels):
+        self.labels = tuple(labels.items())
+        self.started = time.time()
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> function returning the current value
+        self.gauges = {}
+        # (name, labels) -> Histogram
+        self.histograms = {}
+        # name -> bucket bounds for the histograms that don't measure latency
+        self.buckets = {}
+        self.endpoint = None
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(labels.items()))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, function, **labels):
+        '''Read the gauge by calling function whenever the metrics are asked for'''
+        self.gauges[(name, tuple(labels.items()))] = function
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(labels.items()))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(self.buckets.get(name, LATENCY_BUCKETS))
+        histogram.observe(value)
+
+    def sample_name(self, name, labels):
+        return f"{name}{format_labels(labels)}"
+
+    def snapshot(self):
+        '''Every metric as plain values, histograms cut down to their count, mean and percentiles'''
+        return {
+            'uptime': round(time.time() - self.started, 1),
+            'counters': {self.sample_name(*key): value for key, value in sorted(self.counters.items())},
+            'gauges': {self.sample_name(*key): function() for key, function in sorted(self.gauges.items(), key=lambda item: item[0])},
+            'histograms': {self.sample_name(*key): histogram.summary() for key, histogram in sorted(self.histograms.items(), key=lambda item: item[0])}
+        }
+
+    def report(self):
+        '''The snapshot as lines of text for the stats command'''
+        snapshot = self.snapshot()
+        lines = [f"Metrics over {snapshot['uptime']}s"]
+        for section in ('counters', 'gauges'):
+            lines.append(f"  {section.capitalize()}:")
+            lines.extend(f"\t{name}: {value}" for name, value in snapshot[section].items())
+        lines.append("  Histograms (bucket upper bounds):")
+        for name, summary in snapshot['histograms'].items():
+            lines.append(f"\t{name}: {summary['count']} observed, mean {summary['mean']}, "
+                         f"p50 {summary['p50']}, p90 {summary['p90']}, p99 {summary['p99']}")
+
+        return '\n'.join(lines)
+
+    def render(self):
+        '''Every metric in the Prometheus text exposition format'''
+        lines = []
+        typed = set()
+        def sample(name, type, labels, value):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {PREFIX}{name} {type}")
+            lines.append(f"{PREFIX}{name}{format_labels(self.labels + labels)} {value}")
+
+        for (name, labels), value in sorted(self.counters.items()):
+            sample(name, 'counter', labels, value)
+        for (name, labels), function in sorted(self.gauges.items(), key=lambda item: item[0]):
+            sample(name, 'gauge', labels, function())
+        for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append(f"{PREFIX}{name}_bucket{format_labels(self.labels + labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{format_labels(self.labels + labels)} {histogram.sum}")
+            lines.append(f"{PREFIX}{name}_count{format_labels(self.labels + labels)} {histogram.count}")
+
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, endpoint):
+        '''
+            Answer HTTP GETs for /metrics on the running event loop, endpoint is a local TCP port
+            or the path of a Unix socket
+        '''
+        if isinstance(endpoint, int):
+            self.endpoint = await asyncio.start_server(self.handle_http, '127.0.0.1', endpoint)
+        else:
+            os.makedirs(os.path.dirname(endpoint) or '.', exist_ok=True)
+            if os.path.exists(endpoint):
+                # Left behind by a process that didn't get to clean up
+                os.remove(endpoint)
+            self.endpoint = await asyncio.start_unix_server(self.handle_http, endpoint)
+
+    async def handle_http(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+
+            path = request.split()[1] if len(request.split()) > 1 else b''
+            if path in (b'/', b'/metrics'):
+                status, body = '200 OK', self.render().encode('utf-8')
+            else:
+                status, body = '404 Not Found', b'Only /metrics is served here\n'
+            writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         f"Content-Length: {len(body)}\r\n\r\n".encode('ascii') + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,295 @@
+'''
+Developer: Austin Spencer
+Class: CSE 434 Computer Networks
+Professor: Syrotiuk
+Due: 10/17/2021
+Group: 85
+Ports: 4300 - 43499
+
+About:  Purpose of this project is to implement your own application program in which processes
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
+    answer queries using it.
+
+reliable.py:
+    - This script contains the ReliableChannel class that sits under a UDPServer and makes sure datagrams
+    get to each peer in order. Every datagram gets a sequence number, the receiver answers with a
+    cumulative ack and anything not acked within the retransmission timeout (worked out from the
+    measured round trip times) is sent again, a gap is also resent as soon as three duplicate acks
+    point at it. Only a window of datagrams is in flight per peer at a time. A receiver that restarted and
+    lost the session answers with a reset and the sender resends what is left under a new session.
+
+'''
+
+
+from collections import deque
+import asyncio
+import random
+import struct
+import time
+
+
+MAGIC = b'DR' # Can't be mistaken for a wire.py frame, JSON or a command
+DATA = 0
+ACK = 1
+RESET = 2 # The receiver never saw the start of the session, so the sender has to begin a new one
+
+# magic, kind, session, sequence number (the last in order sequence number received for an ack)
+HEADER = struct.Struct('!2sBII')
+
+WINDOW = 32 # Datagrams in flight per peer before the rest are queued
+INITIAL_RTO = 0.2
+MIN_RTO = 0.02
+MAX_RTO = 2.0
+MAX_RETRIES = 8
+DUPLICATE_ACKS = 3 # Duplicate acks that mean the datagram after the ack was lost
+
+
+def is_reliable(data):
+    return data[:2] == MAGIC
+
+
+class ReliableChannel:
+    '''Sequence numbers, cumulative acks, adaptive retransmission and a send window for one UDPServer'''
+    def __init__(self, server, window=WINDOW, max_retries=MAX_RETRIES):
+        self.server = server
+        self.window = window
+        self.max_retries = max_retries
+        # addr -> Peer
+        self.peers = {}
+        self.retransmissions = 0
+        self.give_ups = 0
+
+    class Peer:
+        '''Send and receive state kept for each address talked to'''
+        def __init__(self):
+            # A new session tells the receiver to start the sequence numbers over
+            self.session = random.getrandbits(32)
+            self.next_seq = 1
+            # seq -> [frame, time sent, retries, future]
+            self.unacked = {}
+            self.queue = deque()
+            self.srtt = None
+            self.rttvar = None
+            self.rto = INITIAL_RTO
+            self.timer = None
+            self.last_ack = 0
+            self.duplicate_acks = 0
+            # Highest sequence number in flight when a loss was found, every gap up to it is resent on a partial ack
+            self.recover = 0
+
+            self.recv_session = None
+            self.expected = 1
+            self.out_of_order = {}
+
+    def peer(self, addr):
+        addr = tuple(addr)
+        if addr not in self.peers:
+            self.peers[addr] = self.Peer()
+
+        return self.peers[addr]
+
+    def send(self, data, addr):
+        '''Queue the datagram for the address, returns a future that is done once the peer acks it'''
+        peer = self.peer(addr)
+        future = asyncio.get_running_loop().create_future()
+        # Nobody has to wait on the future, so don't warn about failures nobody looked at
+        future.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+        self.enqueue(peer, tuple(addr), data, future)
+        return future
+
+    def enqueue(self, peer, addr, data, future):
+        '''Give the datagram the next sequence number and send it if the window has room'''
+        seq = peer.next_seq
+        peer.next_seq += 1
+        frame = HEADER.pack(MAGIC, DATA, peer.session, seq) + data
+        if len(peer.unacked) < self.window:
+            self.transmit(peer, addr, seq, [frame, 0, 0, future])
+        else:
+            peer.queue.append((seq, [frame, 0, 0, future]))
+
+    def transmit(self, peer, addr, seq, entry):
+        entry[1] = time.perf_counter()
+        peer.unacked[seq] = entry
+        self.server.send_raw(entry[0], addr)
+        if not peer.timer:
+            self.arm(peer, addr)
+
+    def arm(self, peer, addr):
+        peer.timer = asyncio.get_running_loop().call_later(peer.rto, self.timeout, peer, addr)
+
+    def retransmit(self, peer, addr, seq):
+        '''Send the datagram again, returns False if it has already been tried too many times'''
+        entry = peer.unacked[seq]
+        if entry[2] >= self.max_retries:
+            self.give_up(peer, addr, seq)
+            return False
+
+        entry[2] += 1
+        entry[1] = time.perf_counter()
+        self.retransmissions += 1
+        self.server.send_raw(entry[0], addr)
+        return True
+
+    def timeout(self, peer, addr):
+        '''
+            Resend the oldest datagram once it has waited longer than the timeout, backing the timeout off each time
+            The receiver holds on to what came after it so one cumulative ack usually covers the rest
+        '''
+        peer.timer = None
+        if not peer.unacked:
+            return
+
+        seq = min(peer.unacked)
+        if time.perf_counter() - peer.unacked[seq][1] >= peer.rto:
+            if not self.retransmit(peer, addr, seq):
+                return
+            peer.recover = max(peer.unacked)
+            peer.rto = min(peer.rto * 2, MAX_RTO)
+        self.arm(peer, addr)
+
+    def give_up(self, peer, addr, seq):
+        '''The peer stopped acking, fail everything still headed to it and start a new session'''
+        print(f"reliable: no ack from {addr[0]}:{addr[1]} for datagram {seq} after {self.max_retries} retries, giving up")
+        error = asyncio.TimeoutError(f"No ack from {addr[0]}:{addr[1]} after {self.max_retries} retries")
+        self.give_ups += 1
+        for entry in list(peer.unacked.values()) + [entry for _, entry in peer.queue]:
+            if not entry[3].done():
+                entry[3].set_exception(error)
+
+        self.new_session(peer, addr)
+
+    def new_session(self, peer, addr):
+        '''Start the sending side over with a new session, whatever was received from the peer is kept'''
+        if peer.timer:
+            peer.timer.cancel()
+            peer.timer = None
+        fresh = self.Peer()
+        fresh.recv_session = peer.recv_session
+        fresh.expected = peer.expected
+        fresh.out_of_order = peer.out_of_order
+        self.peers[addr] = fresh
+
+        return fresh
+
+    def reset(self, peer, addr, session):
+        '''The peer restarted and lost the session, resend everything it hasn't acked under a new session'''
+        if session != peer.session:
+            return
+
+        entries = [peer.unacked[seq] for seq in sorted(peer.unacked)] + [entry for _, entry in peer.queue]
+        fresh = self.new_session(peer, addr)
+        for frame, _, _, future in entries:
+            if not future.done():
+                self.enqueue(fresh, addr, frame[HEADER.size:], future)
+
+    def datagram_received(self, data, addr):
+        '''Handle a reliable frame, returns the payloads that are now in order and ready to hand off'''
+        if len(data) < HEADER.size:
+            return []
+
+        _, kind, session, seq = HEADER.unpack_from(data)
+        peer = self.peer(addr)
+        if kind == ACK:
+            self.acked(peer, tuple(addr), session, seq)
+            return []
+        if kind == RESET:
+            self.reset(peer, tuple(addr), session)
+            return []
+
+        if session != peer.recv_session:
+            if seq != 1:
+                # Picking the session up part way would wait forever on datagrams that were acked before a restart
+                self.server.send_raw(HEADER.pack(MAGIC, RESET, session, seq), addr)
+                return []
+            peer.recv_session = session
+            peer.expected = 1
+            peer.out_of_order = {}
+
+        ready = []
+        if seq == peer.expected:
+            ready.append(data[HEADER.size:])
+            peer.expected += 1
+            while peer.expected in peer.out_of_order:
+                ready.append(peer.out_of_order.pop(peer.expected))
+                peer.expected += 1
+        elif seq > peer.expected and len(peer.out_of_order) < 4 * self.window:
+            peer.out_of_order[seq] = data[HEADER.size:]
+
+        # Anything below expected is a duplicate of something already handed off, it still gets acked
+        self.server.send_raw(HEADER.pack(MAGIC, ACK, session, peer.expected - 1), addr)
+        return ready
+
+    def acked(self, peer, addr, session, ack):
+        '''Cumulative ack, every datagram up to and including ack got there'''
+        if session != peer.session:
+            return
+
+        if ack < peer.last_ack:
+            # An older ack that got reordered behind a newer one
+            return
+        if ack == peer.last_ack:
+            peer.duplicate_acks += 1
+            if peer.duplicate_acks == DUPLICATE_ACKS and ack + 1 in peer.unacked:
+                # Fast retransmit, the receiver keeps getting datagrams past a gap
+                peer.recover = max(peer.unacked)
+                self.retransmit(peer, addr, ack + 1)
+            return
+
+        peer.last_ack = ack
+        peer.duplicate_acks = 0
+        acked = [peer.unacked.pop(seq) for seq in sorted(peer.unacked) if seq <= ack]
+        # Only time an ack that covers datagrams sent once, a retransmitted one could be acking either copy and
+        # datagrams held up behind a gap would count the whole recovery as round trip time
+        if acked and not any(retries for _, _, retries, _ in acked):
+            self.sample_rtt(peer, time.perf_counter() - acked[-1][1])
+        elif peer.srtt is not None:
+            # The peer is answering again so drop the backoff, otherwise heavy loss keeps it at MAX_RTO
+            peer.rto = min(max(peer.srtt + 4 * peer.rttvar, MIN_RTO), MAX_RTO)
+        for _, _, _, future in acked:
+            if not future.done():
+                future.set_result(True)
+
+        if ack < peer.recover and ack + 1 in peer.unacked:
+            # Partial ack, the next gap was lost in the same burst so don't wait for a timeout on it
+            if not self.retransmit(peer, addr, ack + 1):
+                return
+
+        while peer.queue and len(peer.unacked) < self.window:
+            seq, entry = peer.queue.popleft()
+            self.transmit(peer, addr, seq, entry)
+
+        if peer.timer:
+            peer.timer.cancel()
+            peer.timer = None
+        if peer.unacked:
+            self.arm(peer, addr)
+
+    def sample_rtt(self, peer, rtt):
+        '''Jacobson/Karels smoothing of the round trip time'''
+        if self.server.metrics:
+            self.server.metrics.observe('reliable_rtt_ms', rtt * 1000, socket=self.server.name)
+        if peer.srtt is None:
+            peer.srtt = rtt
+            peer.rttvar = rtt / 2
+        else:
+            peer.rttvar = 0.75 * peer.rttvar + 0.25 * abs(peer.srtt - rtt)
+            peer.srtt = 0.875 * peer.srtt + 0.125 * rtt
+        peer.rto = min(max(peer.srtt + 4 * peer.rttvar, MIN_RTO), MAX_RTO)
+
+    def in_flight(self):
+        '''Datagrams sent and waiting on an ack'''
+        return sum(len(peer.unacked) for peer in self.peers.values())
+
+    def queued(self):
+        '''Datagrams waiting for room in the send window'''
+        return sum(len(peer.queue) for peer in self.peers.values())
+
+    def pending(self):
+        '''Futures of every datagram that hasn't been acked yet'''
+        futures = []
+        for peer in self.peers.values():
+            futures.extend(entry[3] for entry in peer.unacked.values())
+            futures.extend(entry[3] for _, entry in peer.queue)
+
+        return futures
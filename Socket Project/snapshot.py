@@ -0,0 +1,88 @@
+'''
+Developer: Austin Spencer
+Class: CSE 434 Computer Networks
+Professor: Syrotiuk
+Due: 10/17/2021
+Group: 85
+Ports: 4300 - 43499
+
+About:  Purpose of this project is to implement your own application program in which processes
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
+    answer queries using it.
+
+snapshot.py:
+    - This script writes a node's local store to disk and reads it back. A snapshot is a fixed header
+    holding the DHT epoch, the node's id and n and the record count, followed by the membership list and
+    the records in the wire.py binary encoding so every record shares one list of column names. Snapshots
+    are written to a temporary file and renamed over the old one so a crash never leaves half of one behind,
+    and they are read straight out of a memory map
+
+'''
+
+
+import mmap
+import os
+import struct
+import wire
+
+
+MAGIC = b'DS'
+VERSION = 1
+
+# magic, version, epoch, id, n, record count
+HEADER = struct.Struct('!2sBIIII')
+
+
+def snapshot_path(directory, username):
+    return os.path.join(directory, f"{username}.snapshot")
+
+
+def write_snapshot(path, epoch, id, n, dht, records):
+    '''Write the snapshot atomically, returns the size of the file'''
+    body = bytearray()
+    wire.encode_value({'dht': dht, 'records': records}, body, {})
+
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'wb') as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, VERSION, epoch, id, n, len(records)))
+        snapshot_file.write(body)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temp_path, path)
+
+    return HEADER.size + len(body)
+
+
+def read_header(path):
+    '''
+        Returns {epoch, id, n, count} without reading the rest of the snapshot
+        Raises ValueError if the file isn't a snapshot this version can read
+    '''
+    with open(path, 'rb') as snapshot_file:
+        data = snapshot_file.read(HEADER.size)
+
+    if len(data) < HEADER.size:
+        raise ValueError(f"{path} is too short to be a snapshot")
+    magic, version, epoch, id, n, count = HEADER.unpack(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} isn't a version {VERSION} snapshot")
+
+    return {'epoch': epoch, 'id': id, 'n': n, 'count': count}
+
+
+def read_snapshot(path):
+    '''Returns (header, dht, records) decoded out of a memory map of the snapshot'''
+    header = read_header(path)
+    with open(path, 'rb') as snapshot_file:
+        with mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            try:
+                body, _ = wire.decode_value(mapped, HEADER.size, [])
+                dht, records = body['dht'], body['records']
+            except (struct.error, IndexError, KeyError, TypeError, UnicodeDecodeError) as error:
+                raise ValueError(f"{path} is corrupt, {error}")
+
+    if len(records) != header['count']:
+        raise ValueError(f"{path} holds {len(records)} records, the header says {header['count']}")
+
+    return header, dht, records
@@ -11,26 +11,40 @@ About:  Purpose of this project is to implement your own application program in
     answer queries using it.
 
 state.py:
-    - This script keeps the state table and handles the commands given from the client
+    - This script keeps the state table and handles the commands given from the client. Users are also
+    indexed by state and the DHT maintainers kept in an array so no command has to scan every user
 
 '''
 
 
 import json
+from membership import join_membership, leave_membership, remove_membership
 import random
 
 
 class StateInfo:
-    def __init__(self, port):
+    def __init__(self, port, vnodes=0):
         self.state_table = {} # Initialize empty dictionary for the state table
         self.server_port = port
-        self.ports = [port]
+        self.vnodes = vnodes # Virtual nodes per member on the hash ring, 0 partitions by pos % n
+        # Ports are kept as the strings they are registered with
+        self.ports = {str(port)}
+        # state -> usernames in that state
+        self.by_state = {'Free': set(), 'Leader': set(), 'InDHT': set()}
+        # Leader and InDHT usernames in an array for O(1) random picks, index keeps each one's position
+        self.maintainers = []
+        self.maintainer_index = {}
         self.dht_flag = False
         self.creating_dht = False
         self.stabilizing_dht = False
         self.tearing_down_dht = False
         self.dht_leader = None
         self.leaving_user = None
+        self.joining_user = None
+        # Goes up every time the DHT membership changes so nodes know when cached results are stale
+        self.epoch = 0
+        # Membership list kept in step with the one on the nodes so clients can route queries themselves
+        self.dht = []
 
     class User:
         '''The User class will have as many instances as users registered'''
@@ -42,15 +56,35 @@ class StateInfo:
             self.client_query_port = int(ports[1])
             self.state = 'Free'
     
+    def set_state(self, username, state):
+        '''Move the user to the given state, None takes it out of the indexes, keeping every index in step'''
+        user = self.state_table[username]
+        self.by_state[user.state].discard(username)
+        if username in self.maintainer_index and state not in ('Leader', 'InDHT'):
+            # Swap the last maintainer into this one's slot so the removal is O(1)
+            index = self.maintainer_index.pop(username)
+            last = self.maintainers.pop()
+            if last != username:
+                self.maintainers[index] = last
+                self.maintainer_index[last] = index
+        elif username not in self.maintainer_index and state in ('Leader', 'InDHT'):
+            self.maintainer_index[username] = len(self.maintainers)
+            self.maintainers.append(username)
+
+        if state:
+            user.state = state
+            self.by_state[state].add(username)
+
     def reset_dht(self):
         # Set every user to state of Free
-        for username in self.state_table.keys():
-            self.state_table[username].state = 'Free'
+        for username in list(self.maintainers):
+            self.set_state(username, 'Free')
         
         self.dht_flag = False
         self.tearing_down_dht = False
         self.dht_leader = None
-        self.ports = [self.server_port]
+        self.dht = []
+        self.epoch += 1
 
     def valid_user(self, user):
         '''Helper function to check if the user given is valid for registry'''
@@ -85,12 +119,13 @@ class StateInfo:
         if err:
             return None, err
 
-        # Add ports to the list of ports so that they are reserved
-        self.ports.append(data_list[3])
-        self.ports.append(data_list[4])
-
         user = self.User(data_list[1], data_list[2], data_list[3:])
+
+        # Add ports to the set of ports so that they are reserved
+        self.ports.add(data_list[3])
+        self.ports.add(data_list[4])
         self.state_table[user.username] = user
+        self.by_state['Free'].add(user.username)
         
         return f"{data_list[1]} added to state table successfully", None
 
@@ -111,7 +146,10 @@ class StateInfo:
         if user_to_deregister.state != 'Free':
             return None, "User given is not in Free state"
         else:
-            self.state_table[user_to_deregister.username].registered = False
+            self.set_state(user_to_deregister.username, None)
+            # Free the ports up for the next user
+            self.ports.discard(str(user_to_deregister.client_port))
+            self.ports.discard(str(user_to_deregister.client_query_port))
             del self.state_table[user_to_deregister.username]
 
         return "Successfully removed user from state table", None
@@ -141,31 +179,38 @@ class StateInfo:
         dht_id = 1
         
         # Setting up the local State Table, server response message, and updating state_table
+        leader = self.state_table[data_list[2]]
+        self.set_state(leader.username, 'Leader')
+        setup_dht_response.append({
+            'n': n,
+            'id': 0,
+            'username': leader.username,
+            'ip': leader.ipv4,
+            'port': leader.client_port,
+            'query': leader.client_query_port,
+            'vnodes': self.vnodes
+        })
+        # The rest of the DHT is the first users to register, stopping as soon as there are n
         for key, value in self.state_table.items():
-            if key == data_list[2]:
-                self.state_table[key].state = 'Leader'
-                setup_dht_response.insert(0, {
-                    'n': n,
-                    'id': 0,
-                    'username': value.username,
-                    'ip': value.ipv4,
-                    'port': value.client_port,
-                    'query': value.client_query_port
-                })
-            elif value.state != 'InDHT' and dht_id != n:
-                self.state_table[key].state = 'InDHT'
+            if dht_id == n:
+                break
+            if value.state == 'Free':
+                self.set_state(key, 'InDHT')
                 setup_dht_response.append({
                     'n': n,
                     'id': dht_id,
                     'username': value.username,
                     'ip': value.ipv4,
                     'port': value.client_port,
-                    'query': value.client_query_port
+                    'query': value.client_query_port,
+                    'vnodes': self.vnodes
                 })
                 dht_id += 1    
         
         self.dht_flag = True
         self.creating_dht = True
+        self.dht = [dict(node) for node in setup_dht_response]
+        self.epoch += 1
 
         return setup_dht_response, None
 
@@ -189,18 +234,61 @@ class StateInfo:
             return None, f"{data_list[1]} is currently maintaining the DHT. Only free users can query the DHT."
 
         # All checks passed so this is a valid query command
-        maintainers = ['Leader', 'InDHT']
-        dht_maintainers = [user for user in self.state_table.values() if user.state in maintainers]
-        random_user_index = random.randrange(len(dht_maintainers))
-        random_user = dht_maintainers[random_user_index]
+        random_user = self.state_table[random.choice(self.maintainers)]
         random_user = {
             'username': random_user.username,
             'ip': random_user.ipv4,
-            'query': random_user.client_query_port
+            'query': random_user.client_query_port,
+            'epoch': self.epoch
         }
 
         return random_user, None
 
+    def get_view(self, data_list):
+        '''
+            Hand a free user the membership list so it can send queries straight to the owner
+            If the user already has the view for the current epoch only the epoch is sent back
+
+            ex: get-view ⟨username⟩ [epoch]
+        '''
+        if len(data_list) not in (2, 3):
+            return None, "Invalid number of arguments - expected 2 or 3."
+
+        if not self.dht_flag:
+            return None, "There is no DHT created"
+
+        if data_list[1] not in self.state_table.keys():
+            return None, f"{data_list[1]} is not registered with the server"
+
+        if self.state_table[data_list[1]].state != 'Free':
+            return None, f"{data_list[1]} is currently maintaining the DHT. Only free users can query the DHT."
+
+        if len(data_list) == 3 and data_list[2] == str(self.epoch):
+            return {'epoch': self.epoch, 'dht': None}, None
+
+        return {'epoch': self.epoch, 'dht': self.dht}, None
+
+    def restore_view(self, data_list):
+        '''
+            Hand a maintainer the membership list and epoch so it can tag its snapshot with them or
+            check a snapshot it saved before restarting is still good to load
+
+            ex: restore-view ⟨username⟩
+        '''
+        if len(data_list) != 2:
+            return None, "Invalid number of arguments - expected 2."
+
+        if not self.dht_flag:
+            return None, "There is no DHT created"
+
+        if data_list[1] not in self.state_table.keys():
+            return None, f"{data_list[1]} is not registered with the server"
+
+        if data_list[1] not in self.maintainer_index:
+            return None, f"{data_list[1]} isn't maintaining the DHT"
+
+        return {'epoch': self.epoch, 'dht': self.dht}, None
+
     def join_dht(self, data_list):
         '''
             Checking if join-dht command is valid and if it is then send response with information
@@ -242,10 +330,7 @@ class StateInfo:
         if not self.dht_flag:
             return None, "There is no DHT created"
             
-        maintainers = ['Leader', 'InDHT']
-        dht_maintainers = [user for user in self.state_table.values() if user.state in maintainers]
-
-        if (len(dht_maintainers)) < 2:
+        if len(self.maintainers) < 2:
             return None, "Current DHT doesn't have enough maintainers for anyone to leave"
 
         if data_list[1] not in self.state_table.keys():
@@ -269,17 +354,17 @@ class StateInfo:
             if data_list[1] != self.leaving_user:
                 return None, "Only the user who initiated the leave-dht can respond with complete"
             
-            for user, value in self.state_table.items():
-                if value.state == 'Leader':
-                    value.state = 'InDHT'
-                    self.state_table[user] = value
+            for user in list(self.by_state['Leader']):
+                self.set_state(user, 'InDHT')
         
-            self.state_table[self.leaving_user].state = 'Free'
-            self.state_table[data_list[2]].state = 'Leader'
+            self.set_state(self.leaving_user, 'Free')
+            self.set_state(data_list[2], 'Leader')
 
             self.dht_leader = data_list[2]
+            self.dht = leave_membership(self.dht, self.leaving_user)
             self.stabilizing_dht = False
             self.leaving_user = None
+            self.epoch += 1
 
             return "DHT has been successfully rebuilt", None
 
@@ -291,16 +376,59 @@ class StateInfo:
                 return None, "Only the user who initiated the join-dht can respond with complete"
             
             # Updating the state of new DHT maintainer
-            self.state_table[data_list[1]].state = 'InDHT'
+            joined = self.state_table[data_list[1]]
+            self.set_state(joined.username, 'InDHT')
+            # Same entry the DHT leader adds for the joining node
+            self.dht = join_membership(self.dht, {
+                'username': joined.username,
+                'ip': joined.ipv4,
+                'port': joined.client_port,
+                'query': joined.client_query_port,
+                'vnodes': self.vnodes
+            })
 
             self.stabilizing_dht = False
             self.joining_user = None
+            self.epoch += 1
 
             return "DHT has been successfully rebuilt", None
         
         else:
             return "There is no dht-rebuild in process", None
     
+    def node_failed(self, data_list):
+        '''
+            A maintainer stopped answering its predecessor's heartbeats, take it out of the DHT so the
+            state table and n match the nodes that are left, the next node takes over if it was the leader
+            Responds with the new membership list for the reporting node to hand out
+
+            ex: node-failed ⟨username⟩ ⟨failed username⟩
+        '''
+        if len(data_list) != 3:
+            return None, "Invalid number of arguments - expected 3."
+
+        if not self.dht_flag:
+            return None, "There is no DHT created"
+
+        reporter, failed = data_list[1], data_list[2]
+        if reporter not in self.maintainer_index:
+            return None, f"{reporter} is not currently maintaining the DHT"
+
+        if failed not in self.maintainer_index:
+            return None, f"{failed} is not currently maintaining the DHT"
+
+        if reporter == failed:
+            return None, "A node can't report itself as failed"
+
+        self.set_state(failed, 'Free')
+        self.dht = remove_membership(self.dht, failed)
+        if failed == self.dht_leader:
+            self.dht_leader = self.dht[0]['username']
+            self.set_state(self.dht_leader, 'Leader')
+        self.epoch += 1
+
+        return {'epoch': self.epoch, 'dht': self.dht}, None
+
     def teardown_dht(self, data_list):
         '''Simple check to see if the teardown-dht command is valid'''
         if len(data_list) != 2:
@@ -339,4 +467,8 @@ class StateInfo:
         for username, value in self.state_table.items():
             print(f"\n\t{i}:\t{username}\n\t")
             print(json.dumps(vars(value), sort_keys=False, indent=4))
-            i += 1
\ No newline at end of file
+            i += 1
+
+    def display_dht(self):
+        print(f"\nDisplaying the DHT membership at epoch {self.epoch}: ")
+        print(json.dumps(self.dht, sort_keys=False, indent=4))
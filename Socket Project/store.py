@@ -0,0 +1,83 @@
+'''
+Developer: Austin Spencer
+Class: CSE 434 Computer Networks
+Professor: Syrotiuk
+Due: 10/17/2021
+Group: 85
+Ports: 4300 - 43499
+
+About:  Purpose of this project is to implement your own application program in which processes
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
+    answer queries using it.
+
+store.py:
+    - This script contains the LocalStore class that holds the records a node is responsible for.
+    Records are kept in a dictionary by key so lookups and counts don't have to scan any buckets,
+    and secondary indexes map the values of other columns back to the keys holding them
+
+'''
+
+
+class LocalStore:
+    '''Node local storage of records keyed by the key column'''
+    def __init__(self, key_column='Long Name', index_columns=()):
+        self.key_column = key_column
+        self.records = {}
+        # column -> value -> set of keys with that value
+        self.indexes = { column: {} for column in index_columns }
+        # Goes up on every change so a snapshot can tell if there is anything new to save
+        self.changes = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def put(self, record):
+        '''Store the record, replacing any record with the same key'''
+        key = record[self.key_column]
+        if key in self.records:
+            self.unindex(self.records[key])
+        self.records[key] = record
+        self.changes += 1
+
+        for column, index in self.indexes.items():
+            if column in record:
+                index.setdefault(record[column], set()).add(key)
+
+    def unindex(self, record):
+        '''Take the record out of every secondary index'''
+        key = record[self.key_column]
+        for column, index in self.indexes.items():
+            keys = index.get(record.get(column))
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del index[record[column]]
+
+    def get(self, key):
+        '''Return the record with the given key or None if it isn't held here'''
+        return self.records.get(key)
+
+    def remove(self, key):
+        '''Remove the record with the given key, returning it or None if it wasn't held here'''
+        record = self.records.pop(key, None)
+        if record:
+            self.unindex(record)
+            self.changes += 1
+
+        return record
+
+    def find(self, column, value):
+        '''Return every record whose column matches the value, columns without an index are scanned'''
+        if column in self.indexes:
+            return [self.records[key] for key in self.indexes[column].get(value, ())]
+
+        return [record for record in self.records.values() if record.get(column) == value]
+
+    def all_records(self):
+        '''Return a list of every record so the store can be changed while going through them'''
+        return list(self.records.values())
+
+    def clear(self):
+        self.changes += 1
+        self.records = {}
+        self.indexes = { column: {} for column in self.indexes }
@@ -0,0 +1,309 @@
+'''
+Developer: Austin Spencer
+Class: CSE 434 Computer Networks
+Professor: Syrotiuk
+Due: 10/17/2021
+Group: 85
+Ports: 4300 - 43499
+
+About:  Purpose of this project is to implement your own application program in which processes
+    communicate using sockets to maintain a distributed hash table (DHT) dynamically, and
+    answer queries using it.
+
+wire.py:
+    - This script encodes and decodes the messages sent between the server and the nodes. Messages are
+    either JSON (kept around for debugging) or a binary frame with a fixed header holding the version,
+    message type, result, request id and body length. Dicts in the body share their key lists, so a batch
+    of records only spells out the column names once. Commands for the server use the same header with just
+    their arguments as text in the body. Decoding works out the format from the first bytes
+    so every endpoint understands both and answers in whichever format it was asked in
+
+'''
+
+
+import json
+import struct
+
+
+VERSION = 1
+MAGIC = b'DH' # JSON always starts with { and commands with a letter so this can't be mistaken for either
+MAX_DATAGRAM = 65507 # Largest payload a UDP datagram can carry
+FORMATS = ['binary', 'json']
+
+# magic, version, message type, result, request id, body length
+HEADER = struct.Struct('!2sBBBII')
+
+RESULTS = [None, 'SUCCESS', 'FAILURE']
+
+# Message type codes, the position in the list is the code so new types only ever go on the end
+MESSAGE_TYPES = [
+    None,
+    # Node to node
+    'record', 'records', 'set-id', 'teardown', 'handoff', 'reset-id', 'reset-n', 'pull-records',
+    'pull-complete', 'check-nodes', 'query-result', 'find-result',
+    # Server responses
+    'register', 'register-error', 'DHT', 'DHT-error', 'deregister', 'deregister-error', 'query-response',
+    'query-error', 'find-response', 'find-error', 'dht-setup', 'dht-setup-error', 'join-response', 'join-error',
+    'leave-response', 'leave-error', 'rebuilt-response', 'rebuilt-error', 'teardown-response', 'teardown-error',
+    'teardown-complete', 'teardown-complete-error', 'debugging', 'error',
+    # Commands sent to the server
+    'setup-dht', 'query-dht', 'find-dht', 'dht-complete', 'join-dht', 'leave-dht', 'dht-rebuilt',
+    'teardown-dht', 'display-users', 'display-dht',
+    'query-cache', 'get-view', 'view-response', 'view-error', 'batch-result',
+    'heartbeat', 'heartbeat-ack', 'repair', 'node-failed', 'failed-response', 'failed-error',
+    'hot-key', 'stats', 'stats-error', 'join-complete', 'restore-view', 'restore-view-response', 'restore-view-error'
+]
+TYPE_CODES = {type: code for code, type in enumerate(MESSAGE_TYPES)}
+NAMED_TYPE = 255 # The type isn't in the list so its name is the first string of the body
+
+INT64 = struct.Struct('!q')
+UINT64 = struct.Struct('!Q')
+FLOAT = struct.Struct('!d')
+SHORT = struct.Struct('!H')
+LONG = struct.Struct('!I')
+
+
+def is_binary(data):
+    return data[:2] == MAGIC
+
+
+def format_of(data):
+    '''Which format the datagram was sent in'''
+    return 'binary' if is_binary(data) else 'json'
+
+
+def string_blob(strings):
+    '''
+        Pack a run of strings as one NUL separated blob so they can be split back apart in a single call
+        Returns None if one of the strings has a NUL in it
+    '''
+    blob = '\0'.join(strings)
+    if strings and blob.count('\0') != len(strings) - 1:
+        return None
+
+    raw = blob.encode('utf-8')
+    return LONG.pack(len(raw)) + raw
+
+
+def decode_strings(data, offset, count):
+    '''Read a run of count strings packed by string_blob'''
+    length, = LONG.unpack_from(data, offset)
+    offset += 4
+    strings = data[offset:offset + length].decode('utf-8').split('\0') if count else []
+
+    return strings, offset + length
+
+
+def encode_value(value, out, schemas):
+    '''Append the tagged encoding of the value, schemas maps the key tuples already written to their index'''
+    if value is None:
+        out += b'n'
+    elif value is True:
+        out += b't'
+    elif value is False:
+        out += b'f'
+    elif isinstance(value, str):
+        raw = value.encode('utf-8')
+        if len(raw) <= 0xffff:
+            out += b's' + SHORT.pack(len(raw))
+        else:
+            out += b'S' + LONG.pack(len(raw))
+        out += raw
+    elif isinstance(value, int):
+        # Ids, hops and ports all fit in two bytes
+        if 0 <= value <= 0xffff:
+            out += b'p' + SHORT.pack(value)
+        elif -2**63 <= value < 2**63:
+            out += b'i' + INT64.pack(value)
+        elif 0 <= value < 2**64:
+            out += b'u' + UINT64.pack(value)
+        else:
+            raw = str(value).encode('ascii')
+            out += b'b' + SHORT.pack(len(raw)) + raw
+    elif isinstance(value, float):
+        out += b'g' + FLOAT.pack(value)
+    elif isinstance(value, (list, tuple)):
+        out += b'l' + LONG.pack(len(value))
+        for item in value:
+            encode_value(item, out, schemas)
+    elif isinstance(value, dict):
+        keys = tuple(value)
+        index = schemas.get(keys)
+        if index is None:
+            # First dict with these keys, write them out so later ones can point back at them
+            keys = tuple(str(key) for key in keys)
+            index = schemas[keys] = len(schemas)
+            blob = string_blob(keys)
+            if blob is None:
+                raise ValueError("Dict keys sent on the wire can't contain NUL")
+            out += b'K' + SHORT.pack(len(keys)) + blob
+        else:
+            out += b'k' + SHORT.pack(index)
+
+        values = list(value.values())
+        # Records are nothing but strings so they skip the per value tags
+        blob = string_blob(values) if all(type(item) is str for item in values) else None
+        if blob is not None:
+            out += b'r' + blob
+        else:
+            out += b'v'
+            for item in values:
+                encode_value(item, out, schemas)
+    else:
+        raise TypeError(f"Can't encode {type(value).__name__} on the wire")
+
+
+def decode_value(data, offset, schemas):
+    '''Read one tagged value starting at offset, returns the value and the offset just past it'''
+    tag = data[offset:offset + 1]
+    offset += 1
+    if tag == b's':
+        length, = SHORT.unpack_from(data, offset)
+        offset += 2
+        return data[offset:offset + length].decode('utf-8'), offset + length
+    if tag == b'k' or tag == b'K':
+        if tag == b'K':
+            count, = SHORT.unpack_from(data, offset)
+            keys, offset = decode_strings(data, offset + 2, count)
+            schemas.append(keys)
+        else:
+            index, = SHORT.unpack_from(data, offset)
+            offset += 2
+            keys = schemas[index]
+
+        if data[offset:offset + 1] == b'r':
+            values, offset = decode_strings(data, offset + 1, len(keys))
+            return dict(zip(keys, values)), offset
+
+        offset += 1
+        value = {}
+        for key in keys:
+            value[key], offset = decode_value(data, offset, schemas)
+        return value, offset
+    if tag == b'l':
+        count, = LONG.unpack_from(data, offset)
+        offset += 4
+        value = []
+        for _ in range(count):
+            item, offset = decode_value(data, offset, schemas)
+            value.append(item)
+        return value, offset
+    if tag == b'n':
+        return None, offset
+    if tag == b't':
+        return True, offset
+    if tag == b'f':
+        return False, offset
+    if tag == b'p':
+        return SHORT.unpack_from(data, offset)[0], offset + 2
+    if tag == b'i':
+        return INT64.unpack_from(data, offset)[0], offset + 8
+    if tag == b'u':
+        return UINT64.unpack_from(data, offset)[0], offset + 8
+    if tag == b'g':
+        return FLOAT.unpack_from(data, offset)[0], offset + 8
+    if tag == b'S':
+        length, = LONG.unpack_from(data, offset)
+        offset += 4
+        return data[offset:offset + length].decode('utf-8'), offset + length
+    if tag == b'b':
+        length, = SHORT.unpack_from(data, offset)
+        offset += 2
+        return int(data[offset:offset + length].decode('ascii')), offset + length
+
+    raise ValueError(f"Unknown wire tag {tag!r} at offset {offset - 1}")
+
+
+def encode(message, format='binary'):
+    '''Turn the message dict into the bytes of a datagram in the given format'''
+    if format == 'json':
+        return bytes(json.dumps(message), 'utf-8')
+
+    body = bytearray()
+    type = message.get('type')
+    code = TYPE_CODES.get(type, NAMED_TYPE)
+    if code == NAMED_TYPE:
+        encode_value(type, body, {})
+
+    # Everything other than the header fields goes in the body as a single dict
+    rest = {key: value for key, value in message.items() if key not in ('res', 'type', 'rid')}
+    encode_value(rest, body, {})
+
+    header = HEADER.pack(MAGIC, VERSION, code, RESULTS.index(message.get('res')), message.get('rid') or 0, len(body))
+    return header + bytes(body)
+
+
+def read_header(data):
+    '''Check the header of a binary datagram against its length, returns the type code, result and request id'''
+    if len(data) < HEADER.size:
+        raise ValueError("Datagram is shorter than the wire header")
+
+    _, version, code, result, rid, length = HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError(f"Unsupported wire version {version}, this node speaks version {VERSION}")
+    if HEADER.size + length != len(data):
+        raise ValueError(f"Wire body is {len(data) - HEADER.size} bytes, the header says {length}")
+
+    return code, result, rid
+
+
+def decode(data):
+    '''Turn a datagram in either format back into the message dict, raises ValueError if it can't be read'''
+    if not is_binary(data):
+        return json.loads(data.decode('utf-8'))
+
+    code, result, rid = read_header(data)
+    offset = HEADER.size
+    if code == NAMED_TYPE:
+        type, offset = decode_value(data, offset, [])
+    else:
+        type = MESSAGE_TYPES[code]
+
+    rest, _ = decode_value(data, offset, [])
+    message = {}
+    if result:
+        message['res'] = RESULTS[result]
+    if type is not None:
+        message['type'] = type
+    message.update(rest)
+    if rid:
+        message['rid'] = rid
+
+    return message
+
+
+def message_name(message):
+    '''What to call the message in the stats, its type or the command in its data for the untyped node messages'''
+    if message.get('type') is not None:
+        return message['type']
+    return message['data'] if isinstance(message.get('data'), str) else 'none'
+
+
+def encode_command(command, format='binary', rid=None):
+    '''
+        Commands for the server are plain space separated text in json mode, the request id goes first as #rid
+        In binary the header carries the command's type code and request id and the body is just the arguments as text
+    '''
+    if format == 'json':
+        return bytes(f'#{rid} {command}' if rid else command, 'utf-8')
+
+    name, _, arguments = command.strip().partition(' ')
+    code = TYPE_CODES.get(name, NAMED_TYPE)
+    # A command without a code of its own keeps its name at the front of the text
+    body = (arguments if code != NAMED_TYPE else command.strip()).encode('utf-8')
+    return HEADER.pack(MAGIC, VERSION, code, 0, rid or 0, len(body)) + body
+
+
+def decode_command(data):
+    '''Split a command sent to the server in either format into its list of words and its request id, None if it has none'''
+    if not is_binary(data):
+        data_list = data.decode('utf-8').split()
+        if data_list and data_list[0][:1] == '#' and data_list[0][1:].isdigit():
+            return data_list[1:], int(data_list[0][1:])
+        return data_list, None
+
+    code, _, rid = read_header(data)
+    data_list = data[HEADER.size:].decode('utf-8').split()
+    if code != NAMED_TYPE:
+        data_list.insert(0, MESSAGE_TYPES[code])
+    return data_list, rid or None